@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+write precompressed copies of the static files, served by handlers.StaticHandler:
+
+    python assets.py static
+
+every css/js/... file gets a .gz next to it, and a .br if the brotli module is installed.
+a copy is written again only if the file changed after it; main.py runs this at startup.
+"""
+import os
+import gzip
+import argparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# files worth compressing; images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.ico', '.txt', '.json', '.xml')
+
+# Accept-Encoding value -> suffix of the precompressed file, best first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def compress(data, encoding):
+    """
+    :param bytes data: content of a file
+    :param str encoding: 'gzip' or 'br'
+    :rtype: bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # mtime=0, so the same file always gives the same bytes and ETag
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def build(static_path):
+    """
+    :param str static_path: directory of static files
+    :return: number of files written
+    :rtype: int
+    """
+    encodings = [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != 'br' or brotli is not None]
+    written = 0
+    for root, _, names in os.walk(static_path):
+        for name in names:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            mtime = os.path.getmtime(path)
+            data = None
+            for encoding, suffix in encodings:
+                if os.path.isfile(path + suffix) and os.path.getmtime(path + suffix) >= mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data, encoding)
+                if len(compressed) >= len(data):
+                    # never serve a copy of an older version
+                    if os.path.isfile(path + suffix):
+                        os.remove(path + suffix)
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+                written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write precompressed copies of static files')
+    parser.add_argument('static_path', nargs='?', default='static')
+    args = parser.parse_args()
+    print('{} files written'.format(build(args.static_path)))
@@ -0,0 +1,7 @@
+# coding: utf-8
+"""
+benchmarks of the blog; run from the directory of blog.ini:
+
+    python -m benchmarks run --articles 5000 --out before.json
+    python -m benchmarks compare before.json after.json
+"""
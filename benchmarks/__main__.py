@@ -0,0 +1,146 @@
+# coding: utf-8
+import os
+import json
+import sqlite3
+import asyncio
+import argparse
+import platform
+import datetime
+import tempfile
+from benchmarks.synth import make_database
+from benchmarks.load import run_load
+from benchmarks.micro import run_micro
+from benchmarks.snapshot import run_snapshot
+from benchmarks.writes import run_writes
+from benchmarks.memory import run_memory
+
+# metrics in the results, and whether bigger is better
+metrics = {'rps': True, 'p50_ms': False, 'p95_ms': False, 'p99_ms': False, 'ops_per_sec': True, 'mean_us': False}
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, 'bench.db')
+        make_database(dbpath, args.articles, args.content_length, args.seed)
+        results = {
+            'meta': {
+                'time': datetime.datetime.now().isoformat(),
+                'articles': args.articles,
+                'content_length': args.content_length,
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'cold': args.cold,
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+            },
+            'micro': run_micro(dbpath, args.calls, args.seed),
+            'load': asyncio.run(run_load(dbpath, args.requests, args.concurrency, args.cold, args.seed)),
+        }
+    for route, r in results['load'].items():
+        print('{:10} {:8.1f} req/s  p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms  {} errors'.format(
+            route, r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['errors']))
+    for name, r in results['micro'].items():
+        print('{:20} {:12.1f} ops/s {:10.1f} us'.format(name, r['ops_per_sec'], r['mean_us']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def snapshot(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, 'bench.db')
+        make_database(dbpath, args.articles, args.content_length, args.seed)
+        results = run_snapshot(dbpath, args.calls, args.seed)
+    rss = results['rss_mb']
+    print('{} articles loaded in {:.2f} s, {:.1f} MB allocated, {} MB resident'.format(
+        results['articles'], results['load_seconds'], results['snapshot_mb'],
+        'unknown' if rss is None else '{:.1f}'.format(rss)))
+    for name, r in results['reads'].items():
+        print('{:20} {:12.1f} ops/s {:10.1f} us'.format(name, r['ops_per_sec'], r['mean_us']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def writes(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, 'bench.db')
+        make_database(dbpath, args.articles, args.content_length, args.seed)
+        results = run_writes(dbpath, args.writes, args.threads, args.window_ms, args.seed)
+    for name, r in results.items():
+        print('{:10} {:8.1f} writes/s  p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms  {} errors'.format(
+            name, r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['errors']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def memory(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        dbpath = os.path.join(tmp, 'bench.db')
+        make_database(dbpath, args.articles, args.content_length, args.seed)
+        results = run_memory(dbpath, args.pages, seed=args.seed)
+    print('{:.0f} bytes per cached list page, {:.0f} bytes per cached article'.format(
+        results['list_page_bytes'], results['article_bytes']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for group in ('load', 'micro'):
+        for name in sorted(old[group].keys() & new[group].keys()):
+            for metric, bigger_is_better in metrics.items():
+                if metric not in old[group][name]:
+                    continue
+                before, after = old[group][name][metric], new[group][name][metric]
+                change = (after - before) / before * 100 if before else 0.0
+                if after == before:
+                    label = 'same'
+                else:
+                    label = 'better' if (after > before) == bigger_is_better else 'worse'
+                print('{:8} {:20} {:12} {:12.2f} -> {:12.2f} {:+7.1f}% {}'.format(
+                    group, name, metric, before, after, change, label))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='benchmark a synthetic blog')
+    run_parser.add_argument('--articles', type=int, default=1000)
+    run_parser.add_argument('--content-length', type=int, default=4000, help='characters in each article')
+    run_parser.add_argument('--requests', type=int, default=1000, help='requests per route')
+    run_parser.add_argument('--concurrency', type=int, default=20)
+    run_parser.add_argument('--calls', type=int, default=2000, help='calls of each micro benchmark')
+    run_parser.add_argument('--cold', action='store_true', help='disable the result and page caches')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--out', help='write the results as json')
+    snapshot_parser = commands.add_parser('snapshot', help='startup time and memory of the snapshot mode')
+    snapshot_parser.add_argument('--articles', type=int, default=10000)
+    snapshot_parser.add_argument('--content-length', type=int, default=4000, help='characters in each article')
+    snapshot_parser.add_argument('--calls', type=int, default=2000, help='calls of each read')
+    snapshot_parser.add_argument('--seed', type=int, default=0)
+    snapshot_parser.add_argument('--out', help='write the results as json')
+    writes_parser = commands.add_parser('writes', help='write throughput with and without the writer')
+    writes_parser.add_argument('--articles', type=int, default=1000)
+    writes_parser.add_argument('--content-length', type=int, default=4000, help='characters in each article')
+    writes_parser.add_argument('--writes', type=int, default=200, help='writes per thread')
+    writes_parser.add_argument('--threads', type=int, default=8, help='writing threads, and as many readers')
+    writes_parser.add_argument('--window-ms', type=float, default=2, help='write_window_ms of the writer')
+    writes_parser.add_argument('--seed', type=int, default=0)
+    writes_parser.add_argument('--out', help='write the results as json')
+    memory_parser = commands.add_parser('memory', help='memory of cached results')
+    memory_parser.add_argument('--articles', type=int, default=1000)
+    memory_parser.add_argument('--content-length', type=int, default=4000, help='characters in each article')
+    memory_parser.add_argument('--pages', type=int, default=200, help='list pages and articles to cache')
+    memory_parser.add_argument('--seed', type=int, default=0)
+    memory_parser.add_argument('--out', help='write the results as json')
+    compare_parser = commands.add_parser('compare', help='compare two json results')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    args = parser.parse_args()
+    {'run': run, 'snapshot': snapshot, 'writes': writes, 'memory': memory, 'compare': compare}[args.command](args)
@@ -0,0 +1,113 @@
+# coding: utf-8
+import time
+import random
+import asyncio
+import tornado.netutil
+import tornado.httpserver
+from tornado.httpclient import AsyncHTTPClient
+import config
+import db
+import main
+from handlers import encode_cursor, archive_links
+
+
+def make_urls(dbpath, count, seed=0):
+    """
+    urls to request for every route; list pages start at random articles, so deep pages are hit too
+    :param str dbpath: database path
+    :param int count: urls per route
+    :param int seed: random seed
+    :return: route -> urls
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    database = db.BlogDB(dbpath)
+    rows = database.select(['id', 'slug', 'time', 'cat_id'], database.table_name['articles'], [])
+    cats = {row['id']: row['slug'] for row in database.select(['id', 'slug'], database.table_name['category'], [])}
+    dates = archive_links(database.select_archives(), config.archive_months)
+    database.close()
+    samples = [rng.choice(rows) for _ in range(count)]
+    return {
+        'index': ['/'] * count,
+        'article': ['/a/' + row['slug'] for row in samples],
+        'time': [rng.choice(dates)[0] if i % 2 else '/t/_to_/' + encode_cursor('b', row)
+                 for i, row in enumerate(samples)],
+        'cat': ['/c/{}/{}'.format(cats[row['cat_id']], encode_cursor('b', row)) for row in samples],
+    }
+
+
+def summary(latencies, seconds, errors):
+    """
+    :param list[float] latencies: seconds of every request
+    :param float seconds: wall time of all requests
+    :param int errors: responses that are not 200 or 304
+    :rtype: dict
+    """
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[int(p * (len(latencies) - 1))] * 1000 if latencies else 0.0
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+    }
+
+
+async def drive(port, urls, concurrency):
+    """
+    request every url with concurrency requests in flight
+    :rtype: dict
+    """
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = []
+    errors = 0
+    pending = iter(urls)
+
+    async def worker():
+        nonlocal errors
+        for url in pending:
+            start = time.perf_counter()
+            response = await client.fetch('http://127.0.0.1:{}{}'.format(port, url), raise_error=False)
+            latencies.append(time.perf_counter() - start)
+            if response.code not in (200, 304):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+    client.close()
+    return summary(latencies, seconds, errors)
+
+
+async def run_load(dbpath, requests=1000, concurrency=20, cold=False, seed=0):
+    """
+    serve BlogApplication in this process over real http and load every route in turn
+    :param str dbpath: database path
+    :param int requests: requests per route
+    :param int concurrency: requests in flight
+    :param bool cold: disable the result and page caches
+    :param int seed: random seed of the urls
+    :return: route -> summary
+    :rtype: dict
+    """
+    urls = make_urls(dbpath, requests, seed)
+    app = main.make_app(dbpath)
+    if cold:
+        app.database.cache.max_bytes = 0
+        app.page_cache.max_bytes = 0
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+    results = {}
+    try:
+        for route, route_urls in urls.items():
+            results[route] = await drive(port, route_urls, concurrency)
+    finally:
+        server.stop()
+        app.close()
+    return results
@@ -0,0 +1,48 @@
+# coding: utf-8
+import gc
+import random
+import tracemalloc
+import db
+from handlers import decode_cursor, encode_cursor
+
+
+def cached_bytes(database, calls):
+    """
+    :param db.BlogDB database: database with an empty cache
+    :param list[tuple] calls: (method, arguments) to cache
+    :return: bytes allocated per cached result
+    :rtype: float
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for method, args in calls:
+        method(*args)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / len(calls)
+
+
+def run_memory(dbpath, pages=200, limit=21, seed=0):
+    """
+    memory of the result cache: a list page and an article page, as the handlers select them
+    :param str dbpath: database made by benchmarks.synth.make_database
+    :param int pages: list pages and articles to cache
+    :param int limit: articles in a list page, article_num + 1
+    :param int seed: random seed
+    :return: bytes allocated per cached list page and per cached article
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    database = db.BlogDB(dbpath)
+    rows = database.select(['id', 'slug', 'time'], database.table_name['articles'], [])
+    samples = rng.sample(rows, min(pages, len(rows)))
+    cursors = [decode_cursor(encode_cursor('b', row))[0] for row in samples]
+    results = {
+        'list_page_bytes': cached_bytes(database, [(database.select_articles_by_time, (None, None, limit, cursor))
+                                                   for cursor in cursors]),
+        'article_bytes': cached_bytes(database, [(database.select_article, (row['slug'],)) for row in samples]),
+    }
+    database.close()
+    return results
@@ -0,0 +1,48 @@
+# coding: utf-8
+import time
+import random
+import db
+from render import get_overview, render_markdown
+from benchmarks.synth import paragraph
+
+
+def bench(func, number):
+    """
+    :param function func: function without arguments
+    :param int number: calls
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    seconds = time.perf_counter() - start
+    return {
+        'calls': number,
+        'ops_per_sec': number / seconds if seconds else 0.0,
+        'mean_us': seconds / number * 1e6,
+    }
+
+
+def run_micro(dbpath, number=2000, seed=0):
+    """
+    :param str dbpath: database made by benchmarks.synth.make_database
+    :param int number: calls of each benchmark; markdown rendering gets a twentieth of it
+    :param int seed: random seed
+    :return: name -> result of bench
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    database = db.BlogDB(dbpath)
+    table = database.table_name['articles']
+    slugs = [row['slug'] for row in database.select(['slug'], table, [])]
+    html = database.select(['html_content'], table, [], limit=1)[0]['html_content']
+    md = '# title\n\n' + '\n\n'.join(paragraph(rng, 400) for _ in range(10)) + '\n\n```\ncode\n```\n'
+    results = {
+        'DB.select article': bench(lambda: database.select([], table, [('slug', '=', rng.choice(slugs))]), number),
+        'DB.select list page': bench(lambda: database.select(database.list_selection, table, [],
+                                                             order_by=('time', 'id'), desc=True, limit=21), number),
+        'get_overview': bench(lambda: get_overview(html), number),
+        'render_markdown': bench(lambda: render_markdown(md), max(1, number // 20)),
+    }
+    database.close()
+    return results
@@ -0,0 +1,100 @@
+# coding: utf-8
+import gc
+import time
+import random
+import datetime
+import tracemalloc
+import db
+from handlers import decode_cursor, encode_cursor
+from benchmarks.micro import bench
+
+
+def rss_mb():
+    """
+    :return: resident memory of this process, None where /proc is missing
+    :rtype: float|None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * 4096 / 1024 / 1024
+
+
+def check(database, snapshot_database, cursors, cat_slugs, ranges):
+    """
+    raise if the snapshot answers a page differently from the database
+    """
+    for cursor in cursors:
+        before, after = decode_cursor(cursor)
+        for cat_slug in cat_slugs:
+            expected = database.select_articles_by_cat(cat_slug, 21, before, after)
+            got = snapshot_database.select_articles_by_cat(cat_slug, 21, before, after)
+            if [row['id'] for row in expected] != [row['id'] for row in got]:
+                raise RuntimeError('snapshot differs: /c/{}/{}'.format(cat_slug, cursor))
+        for begin, end in ranges:
+            expected = database.select_articles_by_time(begin, end, 21, before, after)
+            got = snapshot_database.select_articles_by_time(begin, end, 21, before, after)
+            if [row['id'] for row in expected] != [row['id'] for row in got]:
+                raise RuntimeError('snapshot differs: /t/{}_to_{}/{}'.format(begin, end, cursor))
+
+
+def run_snapshot(dbpath, number=2000, seed=0):
+    """
+    load a snapshot of a database made by benchmarks.synth.make_database and measure it
+    :param str dbpath: database path
+    :param int number: calls of each read
+    :param int seed: random seed
+    :return: load seconds, memory of the snapshot, and reads from the snapshot against sqlite without cache
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    database = db.BlogDB(dbpath)
+    database.cache.max_bytes = 0
+    # articles without category, cat_id NULL, are in the snapshot too
+    database.add_article('no-category-1', 'no category', None, 'text', '<p>text</p>', 'bench')
+    rows = database.select(['id', 'slug', 'time', 'cat_id'], database.table_name['articles'], [])
+    cat_slugs = [row['slug'] for row in database.select(['slug'], database.table_name['category'], [])]
+
+    gc.collect()
+    rss = rss_mb()
+    snapshot_database = db.SnapshotBlogDB(dbpath)
+    snapshot_database.cache.max_bytes = 0
+    start = time.perf_counter()
+    snapshot_database.load()
+    load_seconds = time.perf_counter() - start
+    gc.collect()
+    rss_after = rss_mb()
+    # tracing slows loading down, so it is measured on a second load
+    snapshot_database.snapshot = None
+    gc.collect()
+    tracemalloc.start()
+    snapshot_database.load()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # and one more, written after the snapshot is loaded
+    snapshot_database.add_article('no-category-2', 'no category', None, 'text', '<p>text</p>', 'bench')
+    samples = [rng.choice(rows) for _ in range(50)]
+    cursors = ['0'] + [encode_cursor(rng.choice('ab'), row) for row in samples]
+    times = sorted(datetime.datetime.fromisoformat(row['time']) for row in rng.sample(rows, min(len(rows), 6)))
+    ranges = [(None, None)] + list(zip(times[::2], times[1::2]))
+    check(database, snapshot_database, cursors, cat_slugs, ranges)
+
+    slugs = [row['slug'] for row in rows]
+    results = {
+        'articles': len(rows),
+        'load_seconds': load_seconds,
+        'snapshot_mb': traced / 1024 / 1024,
+        'rss_mb': None if rss is None else rss_after - rss,
+        'reads': {},
+    }
+    for name, target in (('sqlite', database), ('snapshot', snapshot_database)):
+        results['reads'][name + ' article'] = bench(lambda: target.select_article(rng.choice(slugs)), number)
+        results['reads'][name + ' list page'] = bench(
+            lambda: target.select_articles_by_time(None, None, 21, decode_cursor(
+                encode_cursor('b', rng.choice(rows)))[0]), number)
+    snapshot_database.close()
+    database.close()
+    return results
@@ -0,0 +1,62 @@
+# coding: utf-8
+import random
+import datetime
+import config
+import db
+import main
+
+words = ('tornado sqlite python asyncio cache index query page article blog render template '
+         'markdown keyset cursor pool thread process worker latency throughput').split()
+
+
+def paragraph(rng, length):
+    """
+    :param random.Random rng: random generator
+    :param int length: characters
+    :rtype: str
+    """
+    text = []
+    size = 0
+    while size < length:
+        word = rng.choice(words)
+        text.append(word)
+        size += len(word) + 1
+    return ' '.join(text)
+
+
+def make_database(dbpath, articles=1000, content_length=4000, seed=0, since=datetime.datetime(2016, 10, 1),
+                  until=datetime.datetime(2026, 1, 1)):
+    """
+    create a blog database of synthetic articles, spread over the categories of blog.ini and the time from *since*
+    to *until*; both are fixed, so a seed makes the same database on any day
+    :param str dbpath: path of the new database
+    :param int articles: number of articles
+    :param int content_length: characters in each article
+    :param int seed: random seed, so runs are comparable
+    :param datetime.datetime since: time of the oldest article
+    :param datetime.datetime until: no article is this new
+    :return: slugs of the articles
+    :rtype: list[str]
+    """
+    rng = random.Random(seed)
+    if not main.init_blog_database(dbpath):
+        raise RuntimeError('init failed')
+    database = db.BlogDB(dbpath)
+    seconds = int((until - since).total_seconds())
+    cat_slugs = list(config.categories)
+    rows = []
+    for i in range(articles):
+        paragraphs = [paragraph(rng, 400) for _ in range(max(1, content_length // 400))]
+        rows.append({
+            'slug': 'bench-{}'.format(i),
+            'title': paragraph(rng, 30),
+            'cat_slug': cat_slugs[i % len(cat_slugs)],
+            'md_content': '\n\n'.join(paragraphs),
+            'html_content': ''.join('<p>{}</p>\n'.format(p) for p in paragraphs),
+            'author': 'bench',
+            'time': since + datetime.timedelta(seconds=rng.randrange(seconds)),
+        })
+    if not database.add_articles(rows):
+        raise RuntimeError('insert failed')
+    database.close()
+    return [row['slug'] for row in rows]
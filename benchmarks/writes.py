@@ -0,0 +1,74 @@
+# coding: utf-8
+import time
+import random
+import threading
+import db
+from benchmarks.load import summary
+
+
+def drive(database, slugs, writes, threads, seed):
+    """
+    update titles of random articles from threads threads, while as many threads read articles
+    :param db.BlogDB database: database
+    :param list[str] slugs: slugs of the articles
+    :param int writes: writes per thread
+    :param int threads: writing threads
+    :param int seed: random seed
+    :rtype: dict
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def write(n):
+        nonlocal errors
+        rng = random.Random(seed + n)
+        for i in range(writes):
+            start = time.perf_counter()
+            ok = database.update_article({'title': 'title {} {}'.format(n, i)}, rng.choice(slugs))
+            seconds = time.perf_counter() - start
+            with lock:
+                latencies.append(seconds)
+                errors += not ok
+
+    def read(n):
+        rng = random.Random(seed - n)
+        while not done.is_set():
+            database.select_article(rng.choice(slugs))
+
+    readers = [threading.Thread(target=read, args=(n,)) for n in range(threads)]
+    writers = [threading.Thread(target=write, args=(n,)) for n in range(threads)]
+    for thread in readers:
+        thread.start()
+    start = time.perf_counter()
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    seconds = time.perf_counter() - start
+    done.set()
+    for thread in readers:
+        thread.join()
+    return summary(latencies, seconds, errors)
+
+
+def run_writes(dbpath, writes=200, threads=8, window_ms=2, seed=0):
+    """
+    write throughput and latency with every write committed on its own, then through the writer
+    :param str dbpath: database made by benchmarks.synth.make_database
+    :param int writes: writes per thread
+    :param int threads: writing threads, and as many reading threads
+    :param float window_ms: write_window_ms of the writer
+    :param int seed: random seed
+    :return: 'direct' and 'writer' -> result of benchmarks.load.summary, with writes for requests
+    :rtype: dict
+    """
+    results = {}
+    for name, window in (('direct', None), ('writer', window_ms)):
+        database = db.BlogDB(dbpath, pool_size=threads * 2, write_window_ms=window)
+        database.cache.max_bytes = 0
+        slugs = [row['slug'] for row in database.select(['slug'], database.table_name['articles'], [])]
+        results[name] = drive(database, slugs, writes, threads, seed)
+        database.close()
+    return results
@@ -0,0 +1,283 @@
+# coding: utf-8
+import sys
+import time
+import asyncio
+import inspect
+import sqlite3
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def approx_size(value):
+    """
+    approximate memory used by a query result, in bytes
+    :param value: str, bytes, number, None, sqlite3.Row, a record with __slots__, or list/tuple/dict of them
+    :rtype: int
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, sqlite3.Row):
+        # the stored values; a subclass may convert them when they are read, ex: db.Row
+        size += sum(approx_size(sqlite3.Row.__getitem__(value, i)) for i in range(len(value)))
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif getattr(type(value), '__slots__', None):
+        # the slots as stored, ex: the compressed body of a db.Article
+        size += sum(approx_size(getattr(value, name)) for name in type(value).__slots__)
+    return size
+
+
+class Flight:
+    """
+    a computation of a cache entry that other threads can wait for
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class ResultCache:
+    """
+    thread safe LRU cache bounded by the approximate size of its values instead of the number of entries.
+    keys are tuples whose first item names the kind of entry, ex: ('select_article', 'hello-world'),
+    so related entries can be dropped with self.invalidate_where.
+    self.get_or_set and self.async_get_or_set compute a missing entry once however many callers want it
+    at the same time (single flight), and with stale set, an expired entry is still answered for stale
+    seconds while one refresh runs in the background (stale while revalidate).
+    :param int hits: number of lookups answered from the cache, stale or not
+    :param int misses: number of lookups not in the cache, or expired
+    :param int evictions: number of entries dropped to stay under max_bytes
+    :param int stale_hits: number of lookups answered with an expired entry
+    :param int coalesced: number of misses that waited for the computation of another caller
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=None, sizeof=approx_size, stale=None):
+        """
+        :param int max_bytes: max total size of cached values
+        :param float ttl: seconds an entry stays valid; None means forever
+        :param function sizeof: value -> size in bytes
+        :param float stale: seconds an expired entry is still answered while it is computed again;
+            None means never
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale = stale
+        self._sizeof = sizeof
+        self._data = OrderedDict()  # key -> (value, size, expire time)
+        self._lock = threading.RLock()
+        self._generation = 0  # changed by every invalidation, see self.get_or_set
+        self._flights = {}  # key -> Flight of self.get_or_set computing it
+        self._tasks = {}  # key -> asyncio.Task of self.async_get_or_set computing it
+        self._refresher = None  # threads refreshing stale entries of self.get_or_set, made when needed
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+
+    def _lookup(self, key, allow_stale=False):
+        """
+        :param bool allow_stale: also answer an entry expired less than self.stale seconds ago
+        :return: (found, value, stale)
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if entry[2] is None or entry[2] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0], False
+                if self.stale and entry[2] + self.stale > now:
+                    if allow_stale:
+                        self._data.move_to_end(key)
+                        self.hits += 1
+                        self.stale_hits += 1
+                        return True, entry[0], True
+                else:
+                    self._pop(key)
+            self.misses += 1
+            return False, None, False
+
+    def _pop(self, key):
+        value, size, expire = self._data.pop(key)
+        self.bytes -= size
+
+    def get(self, key, default=None):
+        found, value, _ = self._lookup(key)
+        return value if found else default
+
+    def set(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        expire = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, size, expire)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _store(self, key, value, generation):
+        """
+        a result is not stored if anything was invalidated while it was computed, it may be stale
+        """
+        with self._lock:
+            if generation == self._generation:
+                self.set(key, value)
+
+    def get_or_set(self, key, func, *args):
+        """
+        cached func(*args); func runs without holding the lock.
+        a thread missing a key another thread is computing waits for that result instead of calling func too.
+        """
+        found, value, stale = self._lookup(key, True)
+        if found and not stale:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            computing = flight is None
+            if computing:
+                flight = self._flights[key] = Flight()
+            elif not found:
+                self.coalesced += 1
+        if found:
+            if computing:
+                if self._refresher is None:
+                    self._refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cache-refresh')
+                self._refresher.submit(self._compute, key, flight, func, args)
+            return value
+        if not computing:
+            flight.done.wait()
+            if not flight.failed:
+                return flight.value
+            return func(*args)
+        return self._compute(key, flight, func, args)
+
+    def _compute(self, key, flight, func, args):
+        """
+        func(*args) for the callers waiting for flight, stored under key
+        """
+        generation = self._generation
+        try:
+            flight.value = func(*args)
+            self._store(key, flight.value, generation)
+            return flight.value
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    async def async_get_or_set(self, key, func, *args):
+        """
+        cached await func(*args), for callers on one event loop.
+        a caller missing a key another caller is computing awaits the same task instead of calling func too.
+        :param function func: coroutine function
+        """
+        found, value, stale = self._lookup(key, True)
+        if found and not stale:
+            return value
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = asyncio.ensure_future(self._async_compute(key, func, args))
+                task.add_done_callback(functools.partial(self._task_done, key))
+            elif not found:
+                self.coalesced += 1
+        if found:
+            return value
+        # shielded: a caller that goes away does not cancel the others
+        return await asyncio.shield(task)
+
+    async def _async_compute(self, key, func, args):
+        generation = self._generation
+        value = await func(*args)
+        self._store(key, value, generation)
+        return value
+
+    def _task_done(self, key, task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        if not task.cancelled():
+            # retrieved, so a failed refresh nobody awaits is not reported as never retrieved
+            task.exception()
+
+    def _forget(self, predicate):
+        """
+        computations started before an invalidation may return stale results; later callers start new ones
+        """
+        for running in (self._flights, self._tasks):
+            for key in [k for k in running if predicate(k)]:
+                del running[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if key in self._data:
+                self._pop(key)
+            self._forget(lambda k: k == key)
+
+    def invalidate_where(self, predicate):
+        """
+        :param function predicate: key -> bool; drop the entries it is true for
+        """
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._data if predicate(k)]:
+                self._pop(key)
+            self._forget(predicate)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+            self.bytes = 0
+            self._flights.clear()
+            self._tasks.clear()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_hits': self.stale_hits,
+                'coalesced': self.coalesced,
+            }
+
+
+def cached(method):
+    """
+    cache a method in self.cache, a ResultCache.
+    the key is (method name, every argument with defaults filled in), ex: ('select_article', 'hello-world')
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__,) + bound.args[1:]
+        return self.cache.get_or_set(key, method, self, *bound.args[1:])
+    return wrapper
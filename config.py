@@ -1,55 +1,66 @@
 import configparser
-import datetime
 
-__all__ = ['blog_name', 'categories', 'dates', 'article_num']
+__all__ = ['blog_name', 'categories', 'archive_months', 'article_num', 'db_pool_size', 'cache_max_bytes', 'cache_ttl',
+           'cache_stale', 'page_cache_max_bytes', 'page_cache_ttl', 'render_workers', 'render_timeout',
+           'watch_interval', 'workers', 'slow_query_ms', 'compress_bodies', 'snapshot',
+           'write_window_ms', 'write_queue_size', 'profile_seconds', 'base_url']
 
 config = configparser.ConfigParser()
 config.read('blog.ini', encoding='utf-8')
 
 DEFAULT = config['DEFAULT']
 blog_name = DEFAULT.get('blog_name', "No Name Here")
-from_date = DEFAULT.get('from_date', '201610')
-
-# year and month from config
-from_year = int(from_date[:4])
-from_month = int(from_date[4:])
-assert 1 <= from_month <= 12 and 1970 < from_year < 9999, 'wrong from_date'
-
-# create from_datetime and to_datetime
-from_datetime = datetime.datetime(from_year, from_month, 1)
-to_datetime = datetime.datetime.now()
-
-# add_month_num
-add_month_num = 3
-
-
-# a function that get year and month after add months
-def add_month(year, month, add_num):
-    month = month + add_num
-    if month > 12:
-        year += 1
-        month -= 12
-    elif month <= 0:
-        year -= 1
-        month += 12
-    return year, month
-
-# get dates
-dates = []
-while from_datetime < to_datetime:
-    link = '/t/' + str(from_datetime.timestamp())
-    name_start = '{}年{}月'.format(str(from_datetime.year), str(from_datetime.month))
-    new_year, new_month = add_month(from_datetime.year, from_datetime.month, add_month_num)
-    from_datetime = datetime.datetime(new_year, new_month, 1)  # new from_datetime
-
-    to_year, to_month = add_month(from_datetime.year, from_datetime.month, -1)
-    name_end = '{}年{}月'.format(str(to_year), str(to_month))
-    link += '_to_' + str(from_datetime.timestamp()) + '/0'
-    dates.append((link, name_start+' 至 '+name_end))
+
+# get base_url: scheme and host of the blog, for absolute links in the feed
+base_url = DEFAULT.get('base_url', 'http://localhost:8765').rstrip('/')
+
+# get archive_months: months in an archive period, 3 means quarters
+archive_months = int(DEFAULT.get('archive_months', '3'))
+assert archive_months in (1, 2, 3, 4, 6, 12), 'archive_months must divide 12'
 
 # get article_num
 article_num = int(DEFAULT['article_num'])
 
+# get db_pool_size
+db_pool_size = int(DEFAULT.get('db_pool_size', '5'))
+
+# get cache_max_bytes and cache_ttl; cache_ttl 0 means entries never expire
+cache_max_bytes = int(float(DEFAULT.get('cache_size_mb', '32')) * 1024 * 1024)
+cache_ttl = float(DEFAULT.get('cache_ttl', '0')) or None
+
+# get cache_stale: seconds an expired entry is still used while it is refreshed; 0 means never
+cache_stale = float(DEFAULT.get('cache_stale', '0')) or None
+
+# get page_cache_max_bytes and page_cache_ttl
+page_cache_max_bytes = int(float(DEFAULT.get('page_cache_size_mb', '64')) * 1024 * 1024)
+page_cache_ttl = float(DEFAULT.get('page_cache_ttl', '0')) or None
+
+# get render_workers and render_timeout; render_workers 0 means the number of cpus
+render_workers = int(DEFAULT.get('render_workers', '2')) or None
+render_timeout = float(DEFAULT.get('render_timeout', '30'))
+
+# get watch_interval; 0 means md files are not watched
+watch_interval = float(DEFAULT.get('watch_interval', '2'))
+
+# get workers; 0 means one worker per cpu
+workers = int(DEFAULT.get('workers', '1'))
+
+# get slow_query_ms
+slow_query_ms = float(DEFAULT.get('slow_query_ms', '100'))
+
+# get compress_bodies
+compress_bodies = DEFAULT.getboolean('compress_bodies', False)
+
+# get snapshot
+snapshot = DEFAULT.getboolean('snapshot', False)
+
+# get write_window_ms and write_queue_size; write_window_ms 0 means no writer, every write commits on its own
+write_window_ms = float(DEFAULT.get('write_window_ms', '2')) or None
+write_queue_size = int(DEFAULT.get('write_queue_size', '1000'))
+
+# get profile_seconds: longest run of the profiler of /metrics/profile; 0 means /metrics/profile is off
+profile_seconds = float(DEFAULT.get('profile_seconds', '0'))
+
 # get categories
 cat_names = []
 for name in DEFAULT['cat_names'].split('|'):
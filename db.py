@@ -1,15 +1,418 @@
 # coding: utf-8
+import sys
 import sqlite3
+import asyncio
+import bisect
+import math
+import logging
 import datetime
-from functools import lru_cache
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from cache import ResultCache, cached
+from render import get_overview
+import metrics
+
+log = logging.getLogger('blog.db')
+
+# pragmas applied to every pooled connection
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -8000,  # negative means KiB, so 8 MB per connection
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# around matched text in BlogDB.search_articles; control characters, so they are never in an article
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+
+# a search word shorter than 3 characters is looked for as the trigrams that start with it, see BlogDB._fts_query;
+# a word that starts more trigrams than this, ex: a common single character, is looked for with LIKE instead
+SHORT_WORD_TRIGRAMS = 64
+
+
+def fts_phrase(text):
+    """
+    :param str text: a word of user input
+    :return: the word as an fts5 string, so operators and syntax errors are impossible
+        ex: fts_phrase('OR') == '"OR"'
+    :rtype: str
+    """
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+def like_pattern(text):
+    """
+    :param str text: a word of user input
+    :return: LIKE pattern of text anywhere, with the escape character \\
+    :rtype: str
+    """
+    return '%{}%'.format(text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+
+def compress(text):
+    """
+    :param str text: article body
+    :return: the text zlib compressed as a blob; the text itself if that is not smaller
+    :rtype: bytes|str
+    """
+    if not isinstance(text, str):
+        return text
+    data = text.encode('utf-8')
+    compressed = zlib.compress(data, 6)
+    return compressed if len(compressed) < len(data) else text
+
+
+def decompress(value):
+    """
+    :param bytes|str value: a body as stored, compressed or not
+    :rtype: str
+    """
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+class Row(sqlite3.Row):
+    """
+    sqlite3.Row that decompresses a compressed body every time it is read, never before;
+    rows kept in caches stay compressed
+    """
+
+    def __getitem__(self, key):
+        value = super(Row, self).__getitem__(key)
+        if isinstance(value, bytes):
+            return decompress(value)
+        return value
+
+
+class Record:
+    """
+    immutable article record, smaller than a sqlite3.Row: only __slots__, no column index per row.
+    fields are read as attributes, or by name like a sqlite3.Row, so handlers, templates and the feed take both.
+    DB.select(..., factory=cls.from_row) makes them from rows with the columns in the order of cls.columns
+    """
+    __slots__ = ()
+    columns = ()
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.columns)
+
+    def __reduce__(self):
+        # the stored values, in the order of the arguments of __init__; export sends records to processes
+        return type(self), tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        # stable, export.signature hashes it
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(c, self[c]) for c in self.columns))
+
+
+class ArticleSummary(Record):
+    """
+    an article in a list page: no body
+    """
+    __slots__ = ('id', 'slug', 'title', 'overview', 'time')
+    columns = __slots__
+
+    def __init__(self, id, slug, title, overview, time):
+        init = object.__setattr__
+        init(self, 'id', id)
+        init(self, 'slug', slug)
+        init(self, 'title', title)
+        init(self, 'overview', overview)
+        init(self, 'time', time)
+
+
+class Article(Record):
+    """
+    an article page: the html but no markdown. html_content is kept as stored and decompressed when read,
+    so cached articles stay compressed; authors are interned, a blog has few of them.
+    time is when the article was published, modified when it was last written
+    """
+    __slots__ = ('id', 'slug', 'cat_id', 'title', '_html_content', 'overview', 'author', 'time', 'modified')
+    columns = ('id', 'slug', 'cat_id', 'title', 'html_content', 'overview', 'author', 'time', 'modified')
+
+    def __init__(self, id, slug, cat_id, title, html_content, overview, author, time, modified):
+        init = object.__setattr__
+        init(self, 'id', id)
+        init(self, 'slug', slug)
+        init(self, 'cat_id', cat_id)
+        init(self, 'title', title)
+        init(self, '_html_content', html_content)
+        init(self, 'overview', overview)
+        init(self, 'author', sys.intern(author) if isinstance(author, str) else author)
+        init(self, 'time', time)
+        init(self, 'modified', modified)
+
+    @property
+    def html_content(self):
+        return decompress(self._html_content)
+
+
+def open_connection(dbpath, pragmas):
+    """
+    :param str dbpath: database path
+    :param dict pragmas: pragmas of the connection
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(dbpath, check_same_thread=False)
+    conn.row_factory = Row
+    # used by the full text search triggers and migrations; see init_database.MIGRATIONS
+    conn.create_function('compress', 1, compress, deterministic=True)
+    conn.create_function('decompress', 1, decompress, deterministic=True)
+    for name, value in pragmas.items():
+        conn.execute('PRAGMA {} = {}'.format(name, value))
+    return conn
+
+
+class ConnectionPool:
+    """
+    A fixed size pool of sqlite3 connections.
+    A thread that acquires a connection again before releasing it gets the same one back,
+    so nested calls (ex: select_articles_by_cat -> get_id_by_slug) only use one connection.
+    """
+
+    def __init__(self, dbpath, size=5, pragmas=None, timeout=10):
+        """
+        :param str dbpath: database path
+        :param int size: max number of open connections
+        :param dict pragmas: pragmas for every new connection; None means DEFAULT_PRAGMAS
+        :param float timeout: seconds to wait for a free connection
+        """
+        assert size > 0, 'pool size must be positive'
+        self._dbpath = dbpath
+        self._size = size
+        self._pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()  # LIFO, so the most recently used (warm) connection is reused first
+        self._all = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+
+    def _new_connection(self):
+        """
+        :rtype: sqlite3.Connection
+        """
+        return open_connection(self._dbpath, self._pragmas)
+
+    def acquire(self):
+        """
+        :rtype: sqlite3.Connection
+        """
+        if self._closed:
+            raise sqlite3.ProgrammingError('connection pool is closed')
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            return conn
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if len(self._all) < self._size:
+                    conn = self._new_connection()
+                    self._all.append(conn)
+            if conn is None:
+                try:
+                    conn = self._idle.get(timeout=self._timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError('no free connection in pool after {}s'.format(self._timeout))
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn):
+        """
+        :param sqlite3.Connection conn: connection returned by self.acquire
+        """
+        if getattr(self._local, 'conn', None) is not conn:
+            return
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        """
+        close every idle connection; connections still in use are closed when released
+        """
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        with self._lock:
+            self._all.clear()
+
+
+class Writer:
+    """
+    one thread with its own connection that makes every write of a DB.
+    writes queued while it commits, or within window seconds after the first one, are committed together
+    in one transaction, so they share one fsync and never wait for each other's locks.
+    if one of them fails, the transaction is rolled back and every write is committed alone instead.
+    the queue is bounded: when it is full, a writer waits for room, at most timeout seconds.
+    """
+
+    def __init__(self, database, pragmas, window=0.002, queue_size=1000, max_batch=200, timeout=10):
+        """
+        :param DB database: database the writes belong to; its metrics and logs record them
+        :param dict pragmas: pragmas of the connection
+        :param float window: seconds to wait for more writes after the first one of a transaction
+        :param int queue_size: max number of queued writes
+        :param int max_batch: max number of writes in a transaction
+        :param float timeout: seconds to wait for room in the queue
+        """
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._pragmas = pragmas
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name='blogdb-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def submit(self, op, table, sql, params, many=False):
+        """
+        :param str op: 'insert', 'update' or 'delete'
+        :param str table: table of the statement
+        :param str sql: the statement
+        :param tuple|list params: its parameters; a list of tuples if many
+        :param bool many: run the statement once for every tuple of params
+        :return: future of the number of rows written, -1 if the write failed
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        if not self._thread.is_alive():
+            self.database._failed(op, table, sql, 'writer is closed')
+            future.set_result(-1)
+            return future
+        try:
+            self._queue.put((op, table, sql, params, many, future), timeout=self.timeout)
+        except queue.Full:
+            self.database._failed(op, table, sql, 'write queue full for {}s'.format(self.timeout))
+            future.set_result(-1)
+        return future
+
+    def close(self):
+        """
+        commit the queued writes, then stop
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        conn = open_connection(self.database._dbpath, self._pragmas)
+        conn.isolation_level = None  # transactions are begun and committed here
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        """
+        :param sqlite3.Connection conn: connection of the writer
+        :param list[tuple] batch: queued writes
+        """
+        results = self._execute(conn, batch)
+        if results is None:
+            # one of them failed: commit every write alone, so only that one fails
+            results = [(self._execute(conn, [item]) or [-1])[0] for item in batch] if len(batch) > 1 else [-1]
+        metrics.DB_WRITE_BATCH.observe(len(batch))
+        for item, rows in zip(batch, results):
+            item[-1].set_result(rows)
+
+    def _execute(self, conn, batch):
+        """
+        :param sqlite3.Connection conn: connection of the writer
+        :param list[tuple] batch: queued writes
+        :return: rows written by every write; None if one failed, then nothing is written
+        :rtype: list[int]|None
+        """
+        rows = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for op, table, sql, params, many, _ in batch:
+                start = metrics.now()
+                cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+                self.database._observe(op, table, sql, start, cursor.rowcount)
+                rows.append(cursor.rowcount)
+            start = metrics.now()
+            conn.execute('COMMIT')
+            self.database._observe('commit', '', 'COMMIT', start, 0)
+            return rows
+        except Exception as e:
+            if len(batch) == 1:
+                self.database._failed(batch[0][0], batch[0][1], batch[0][2], e)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            return None
 
 
 class DB:
-    def __init__(self, dbpath='blog.db'):
+    def __init__(self, dbpath='blog.db', pool_size=5, pragmas=None, slow_query_ms=100, write_window_ms=None,
+                 write_queue_size=1000):
         """
         :param str dbpath: database path
+        :param int pool_size: max number of pooled connections
+        :param dict pragmas: pragmas for pooled connections; None means DEFAULT_PRAGMAS
+        :param float slow_query_ms: statements slower than this are logged with their sql
+        :param float write_window_ms: if not None, every write goes through a Writer that waits this long
+            for more writes to commit with; None means every write commits on its own, in the calling thread
+        :param int write_queue_size: max number of writes queued in the Writer
         """
         self._dbpath = dbpath
+        self.pool_size = pool_size
+        self.slow_query_ms = slow_query_ms
+        self._pool = ConnectionPool(dbpath, pool_size, pragmas)
+        self.writer = None
+        if write_window_ms is not None:
+            self.writer = Writer(self, DEFAULT_PRAGMAS if pragmas is None else pragmas, write_window_ms / 1000,
+                                 write_queue_size)
 
     @staticmethod
     def _prepare_conditions(conditions):
@@ -24,6 +427,11 @@ class DB:
             cdt_str, cdt_value = self._prepare_conditions(conditions)
             assert cdt_str == 'id = ? AND name = ?'
             assert cdt_value == (3, 'jeff')
+
+            conditions = [(('time', 'id'), '<', ('2016-10-01', 3))]
+            cdt_str, cdt_value = self._prepare_conditions(conditions)
+            assert cdt_str == '(time,id) < (?,?)'
+            assert cdt_value == ('2016-10-01', 3)
         :param list[tuple[str]]|dict conditions: list of 3-tuple
         :rtype: tuple[str, tuple]
         """
@@ -36,6 +444,13 @@ class DB:
             get_symbol = lambda t: '='
             inner = ','
         for tp in conditions:
+            if isinstance(tp[0], tuple):
+                # row value, compared column by column
+                if any(' ' in column for column in tp[0]) or len(tp[0]) != len(tp[-1]):
+                    return None, None
+                cdt_arr.append('({0}) {1} ({2})'.format(','.join(tp[0]), get_symbol(tp), ','.join(['?'] * len(tp[0]))))
+                cdt_value_arr.extend(tp[-1])
+                continue
             if ' ' in tp[0]:
                 # SQL injection
                 return None, None
@@ -44,13 +459,91 @@ class DB:
         cdt_str = inner.join(cdt_arr)
         return cdt_str, tuple(cdt_value_arr)
 
+    def _observe(self, op, table, sql, start, rows):
+        """
+        record the time and row count of a statement in metrics
+        :param str op: ex: 'select'
+        :param str table: table of the statement
+        :param str sql: the statement, logged if it is slow
+        :param float start: metrics.now() before the statement
+        :param int rows: rows read or written
+        """
+        seconds = metrics.now() - start
+        labels = (op, table)
+        metrics.DB_QUERY_SECONDS.observe(seconds, labels)
+        if rows > 0:
+            metrics.DB_ROWS.inc(labels, rows)
+        if seconds * 1000 >= self.slow_query_ms:
+            metrics.DB_SLOW_QUERIES.inc(labels)
+            log.warning('slow query %.1fms, %d rows: %s', seconds * 1000, rows, sql)
+
+    @staticmethod
+    def _failed(op, table, sql, e):
+        metrics.DB_ERRORS.inc((op, table))
+        log.error('%s failed: %s\n%s', op, e, sql)
+
     def connect(self):
         """
+        get a connection from the pool; give it back with self.release
         :rtype: sqlite3.Connection
         """
-        conn = sqlite3.connect(self._dbpath, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return self._pool.acquire()
+
+    def release(self, conn):
+        """
+        :param sqlite3.Connection conn: connection returned by self.connect
+        """
+        self._pool.release(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        with self.connection() as conn:
+            conn.execute(...)
+        """
+        conn = self.connect()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        commit the queued writes, then close all connections
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self._pool.close()
+
+    def write(self, op, table, sql, params, many=False):
+        """
+        run a write statement and commit it, in the writer if there is one
+        :param str op: 'insert', 'update' or 'delete'
+        :param str table: table of the statement
+        :param str sql: the statement
+        :param tuple|list params: its parameters; a list of tuples if many
+        :param bool many: run the statement once for every tuple of params
+        :return: future of the number of rows written, -1 if the write failed
+        :rtype: concurrent.futures.Future
+        """
+        if self.writer is not None:
+            return self.writer.submit(op, table, sql, params, many)
+        future = Future()
+        rows = -1
+        conn = self.connect()
+        try:
+            start = metrics.now()
+            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            conn.commit()
+            self._observe(op, table, sql, start, cursor.rowcount)
+            rows = cursor.rowcount
+        except Exception as e:
+            self._failed(op, table, sql, e)
+            conn.rollback()
+        finally:
+            self.release(conn)
+            future.set_result(rows)
+            return future
 
     def insert(self, table, value_dict):
         """
@@ -66,29 +559,47 @@ class DB:
         v_tuple = tuple(value_dict.values())
         sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, k_tuple, qs)
 
-        conn = self.connect()
-        try:
-            conn.execute(sql, v_tuple)
-            conn.commit()
-            result = True
-        except Exception as e:
-            print(e)
-            conn.rollback()
-        finally:
-            conn.close()
-            return result
+        result = self.write('insert', table, sql, v_tuple).result() >= 0
+        return result
+
+    def insert_many(self, table, value_dicts, conflict=None, update_columns=None):
+        """
+        INSERT INTO table (keys) VALUES (values) for every dict, with executemany in one transaction
+        :param str table: table to insert
+        :param list[dict] value_dicts: dicts to insert, all with the same keys
+        :param str conflict: a unique column; a row with the same value is updated instead (upsert)
+        :param list[str] update_columns: columns to update on conflict; None means every key but conflict
+        :rtype: bool
+        """
+        result = False
+        if not value_dicts:
+            return True
+
+        keys = list(value_dicts[0].keys())
+        qs = ','.join(['?'] * len(keys))
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ','.join(keys), qs)
+        if conflict is not None:
+            if update_columns is None:
+                update_columns = [k for k in keys if k != conflict]
+            sql += ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                conflict, ','.join('{0} = excluded.{0}'.format(k) for k in update_columns))
 
-    def select(self, columns, table, conditions, order_by=None, desc=False, limit=None, offset=None):
+        params = [tuple(d[k] for k in keys) for d in value_dicts]
+        result = self.write('insert', table, sql, params, many=True).result() >= 0
+        return result
+
+    def select(self, columns, table, conditions, order_by=None, desc=False, limit=None, offset=None, factory=None):
         """
         SELECT columns FROM table WHERE condition AND condition
         note that: columns should not be a string!
         :param tuple|list columns: if columns is (), [] or None, it will be translated to '*'.
         :param str table: table to select
         :param list[tuple[str]] conditions: 3-tuple list; ex: [('author', '=', 'jeff'), ('time', '<', datetime.now())]
-        :param str order_by: order by which column
-        :param bool desc: desc
+        :param str|tuple order_by: order by which column, or a tuple of columns
+        :param bool desc: desc, applied to every column in order_by
         :param int limit: limit number
         :param int offset: offset number
+        :param function factory: (cursor, row tuple) -> result row, ex: Article.from_row; None means a db.Row
         :rtype: list[sqlite3.Row]
         """
         result = None
@@ -102,9 +613,9 @@ class DB:
         else:
             sql = 'SELECT {} FROM {} WHERE {}'.format(sel_str, table, cdt_str)
         if order_by is not None:
-            sql += ' ORDER BY {}'.format(order_by)
-        if desc:
-            sql += ' DESC'
+            if isinstance(order_by, str):
+                order_by = (order_by,)
+            sql += ' ORDER BY {}'.format(','.join(c + ' DESC' if desc else c for c in order_by))
         if limit is not None:
             sql += ' LIMIT {}'.format(limit)
         if offset is not None:
@@ -112,14 +623,18 @@ class DB:
 
         conn = self.connect()
         try:
+            start = metrics.now()
             cursor = conn.cursor()
+            if factory is not None:
+                cursor.row_factory = factory
             cursor.execute(sql, cdt_value)
             result = cursor.fetchall()
+            self._observe('select', table, sql, start, len(result))
         except Exception as e:
-            print(sql, '\n', e)
+            self._failed('select', table, sql, e)
             conn.rollback()
         finally:
-            conn.close()
+            self.release(conn)
             return result
 
     def update(self, table, value_dict, conditions):
@@ -141,17 +656,8 @@ class DB:
         else:
             sql = 'UPDATE {} SET {} WHERE {}'.format(table, value_str, cdt_str)
 
-        conn = self.connect()
-
-        try:
-            conn.execute(sql, value_tuple + cdt_value)
-            conn.commit()
-            result = True
-        except:
-            conn.rollback()
-        finally:
-            conn.close()
-            return result
+        result = self.write('update', table, sql, value_tuple + cdt_value).result() >= 0
+        return result
 
     def delete(self, table, conditions):
         """
@@ -170,28 +676,138 @@ class DB:
         else:
             sql = 'DELETE FROM {} WHERE {}'.format(table, cdt_str)
 
-        conn = self.connect()
-        try:
-            conn.execute(sql, cdt_value)
-            conn.commit()
-            result = True
-        except:
-            conn.rollback()
-        finally:
-            conn.close()
-            return result
+        result = self.write('delete', table, sql, cdt_value).result() >= 0
+        return result
 
 
 class BlogDB(DB):
     """
     :param dict table_name: tables in database. need 'articles', .. attributes
-    :param list selection: columns to select in self.select_article and self.select_articles
+    :param list selection: columns to select in self.select_article
+    :param list list_selection: columns to select in self.select_articles; list pages need no article body
+    :param cache.ResultCache cache: cache of the select_* methods; writes only drop the entries they change
+    :param list listeners: functions called with (slug, cat_slug, time) like self.invalidate_article
+        after an article is written, to drop other caches; (None, None, None) means anything may have changed
+    :param list archive_listeners: functions called without arguments when self.archives changed
+    :param tuple archives: self.select_archives() after the last write; None before self.refresh_archives
+    :param bool compress_bodies: write md_content and html_content zlib compressed; both kinds can be read
     """
 
-    def __init__(self, dbpath='blog.db'):
-        super(BlogDB, self).__init__(dbpath)
-        self.table_name = {'articles': 'articles', 'category': 'cats'}
-        self.selection = []
+    def __init__(self, dbpath='blog.db', pool_size=5, pragmas=None, cache=None, slow_query_ms=100,
+                 compress_bodies=False, write_window_ms=None, write_queue_size=1000):
+        super(BlogDB, self).__init__(dbpath, pool_size, pragmas, slow_query_ms, write_window_ms, write_queue_size)
+        self.table_name = {'articles': 'articles', 'category': 'cats', 'render_cache': 'render_cache',
+                           'md_files': 'md_files', 'changes': 'changes', 'archives': 'archives'}
+        # no md_content: pages never show markdown, see self.select_markdown
+        self.selection = list(Article.columns)
+        self.list_selection = list(ArticleSummary.columns)
+        self.cache = cache if cache is not None else ResultCache()
+        self.listeners = []
+        self.archive_listeners = []
+        self._change_id = None  # id of the last row of the changes table applied by self.apply_changes
+        self.archives = None
+        self.compress_bodies = compress_bodies
+
+    def _body(self, text):
+        """
+        :param str text: md_content or html_content to write
+        :rtype: bytes|str
+        """
+        return compress(text) if self.compress_bodies else text
+
+    def invalidate_article(self, slug, cat_slug, time):
+        """
+        drop cached results an article is in: the article itself, pages of its category and
+        time pages whose range contains its time. other articles and pages stay cached.
+        :param str slug: slug of the article
+        :param str cat_slug: category of the article
+        :param datetime.datetime|str time: time of the article
+        """
+        if isinstance(time, str):
+            time = datetime.datetime.fromisoformat(time)
+
+        def affected(key):
+            if key[0] == 'select_articles_by_cat':
+                return key[1] == cat_slug
+            if key[0] == 'select_articles_by_time':
+                begin, end = key[1], key[2]
+                return (begin is None or begin < time) and (end is None or time < end)
+            return False
+        self.cache.invalidate(('select_article', slug))
+        self.cache.invalidate_where(affected)
+        for listener in self.listeners:
+            listener(slug, cat_slug, time)
+        self.refresh_archives()
+
+    def invalidate_all(self):
+        """
+        drop every cached result, after writes that may have changed anything
+        """
+        self.cache.clear()
+        for listener in self.listeners:
+            listener(None, None, None)
+        self.refresh_archives()
+
+    def refresh_archives(self):
+        """
+        read the archives again after a write and tell archive_listeners if they changed
+        :return: whether the archives changed
+        :rtype: bool
+        """
+        archives = self.select_archives()
+        if archives is None or archives == self.archives:
+            return False
+        first = self.archives is None
+        self.archives = archives
+        if not first:
+            for listener in self.archive_listeners:
+                listener()
+        return True
+
+    def apply_changes(self, clear_above=100):
+        """
+        triggers log every article write in the changes table; invalidate caches for the writes made
+        since the last call, so writes from other processes (workers, importer, ...) are seen.
+        the first call only remembers where the log is.
+        :param int clear_above: with more changes than this, clear the caches instead
+        :return: number of changes applied
+        :rtype: int
+        """
+        table = self.table_name['changes']
+        if self._change_id is None:
+            rows = self.select(['MAX(id) AS id'], table, [])
+            self._change_id = rows[0]['id'] or 0 if rows else 0
+            return 0
+        rows = self.select(['id', 'slug', 'cat_slug', 'time'], table, [('id', '>', self._change_id)], order_by='id')
+        if not rows:
+            return 0
+        self._change_id = rows[-1]['id']
+        if len(rows) > clear_above:
+            self.invalidate_all()
+        else:
+            for row in rows:
+                self.invalidate_article(row['slug'], row['cat_slug'], row['time'])
+        return len(rows)
+
+    def prune_changes(self, days=1):
+        """
+        :param float days: delete changes older than this
+        :rtype: bool
+        """
+        return self.delete(self.table_name['changes'],
+                           [('created', '<', datetime.datetime.utcnow() - datetime.timedelta(days=days))])
+
+    def _stored_article(self, slug):
+        """
+        :param str slug: slug of the article
+        :return: (slug, cat_slug, time) as in the database now, the arguments of self.invalidate_article
+        :rtype: tuple
+        """
+        rows = self.select(['cat_id', 'time'], self.table_name['articles'], [('slug', '=', slug)])
+        if not rows:
+            return None
+        cats = self.select(['slug'], self.table_name['category'], [('id', '=', rows[0]['cat_id'])])
+        return slug, cats[0]['slug'] if cats else None, rows[0]['time']
 
     def add_article(self, slug, title, cat_slug, md_content, html_content, author, time=None):
         """
@@ -206,15 +822,49 @@ class BlogDB(DB):
         :rtype: bool
         """
         cat_id = self.get_id_by_slug(cat_slug)
+        now = datetime.datetime.now()
+        time = time or now
         result = self.insert(self.table_name['articles'], {
             'slug': slug,
             'title': title,
-            'md_content': md_content,
-            'html_content': html_content,
+            'md_content': self._body(md_content),
+            'html_content': self._body(html_content),
+            'overview': get_overview(html_content),
             'author': author,
             'cat_id': cat_id,
-            'time': time or datetime.datetime.now()
+            'time': time,
+            'modified': now
         })
+        if result:
+            self.invalidate_article(slug, cat_slug, time)
+        return result
+
+    def add_articles(self, articles):
+        """
+        add many articles in one transaction; an article whose slug is already there is updated,
+        keeping its time. modified is now for all of them
+        :param list[dict] articles: dicts of slug, title, cat_slug, md_content, html_content, author and
+            optional time, like the arguments of self.add_article
+        :rtype: bool
+        """
+        now = datetime.datetime.now()
+        rows = []
+        for article in articles:
+            rows.append({
+                'slug': article['slug'],
+                'title': article['title'],
+                'md_content': self._body(article['md_content']),
+                'html_content': self._body(article['html_content']),
+                'overview': article.get('overview') or get_overview(article['html_content']),
+                'author': article['author'],
+                'cat_id': self.get_id_by_slug(article['cat_slug']),
+                'time': article.get('time') or now,
+                'modified': now
+            })
+        columns = ['title', 'md_content', 'html_content', 'overview', 'author', 'cat_id', 'modified']
+        result = self.insert_many(self.table_name['articles'], rows, 'slug', columns)
+        if result:
+            self.invalidate_all()
         return result
 
     def delete_article(self, slug):
@@ -223,7 +873,10 @@ class BlogDB(DB):
         :param str slug: slug of the article
         :rtype: bool
         """
+        stored = self._stored_article(slug)
         result = self.delete(self.table_name['articles'], [('slug', '=', slug)])
+        if result and stored:
+            self.invalidate_article(*stored)
         return result
 
     def delete_articles(self, conditions):
@@ -233,74 +886,558 @@ class BlogDB(DB):
         :rtype: bool
         """
         result = self.delete(self.table_name['articles'], conditions)
+        if result:
+            # conditions can match anything
+            self.invalidate_all()
         return result
 
     def update_article(self, value_dict, slug):
         """
         update an article
-        :param dict value_dict: values to update
+        :param dict value_dict: values to update; modified is now if it is not there
         :param str slug: slug of the article
         :rtype: bool
         """
+        value_dict = dict({'modified': datetime.datetime.now()}, **value_dict)
+        if 'html_content' in value_dict:
+            value_dict = dict(value_dict, overview=get_overview(value_dict['html_content']))
+        value_dict = {key: self._body(value) if key in ('md_content', 'html_content') else value
+                      for key, value in value_dict.items()}
+        # where the article is listed before and after the update
+        stored = self._stored_article(slug)
         result = self.update(self.table_name['articles'], value_dict, [('slug', '=', slug)])
+        if result and stored:
+            self.invalidate_article(*stored)
+            updated = self._stored_article(value_dict.get('slug', slug))
+            if updated:
+                self.invalidate_article(*updated)
         return result
 
-    @lru_cache()
+    @cached
     def get_id_by_slug(self, slug):
         result = self.select([], self.table_name['category'], [('slug', '=', slug)])
         return int(result[0]['id']) if result else None
 
-    @lru_cache()
+    @cached
     def select_article(self, slug):
         """
         :param str slug: slug of the article
-        :rtype: sqlite3.Row|None
+        :rtype: Article|None
         """
-        result = self.select(self.selection, self.table_name['articles'], [('slug', '=', slug)])
+        result = self.select(self.selection, self.table_name['articles'], [('slug', '=', slug)],
+                             factory=Article.from_row)
         if len(result) != 0:
             return result[0]
         return None
 
-    def select_articles(self, conditions, limit=20, offset=None):
+    def select_markdown(self, slug):
         """
+        markdown of an article, only needed to write it again
+        :param str slug: slug of the article
+        :rtype: str|None
+        """
+        result = self.select(['md_content'], self.table_name['articles'], [('slug', '=', slug)])
+        return result[0]['md_content'] if result else None
+
+    def select_articles(self, conditions, limit=20, before=None, after=None):
+        """
+        keyset pagination: newest first, seeking on (time, id) so every page costs the same.
         :param list[tuple[str]] conditions: list of 3-tuple; ex: [('author', '=', 'jeff'), ('time', '<', '20160501')]
         :param int limit: limit number
-        :param int offset:offset number
-        :rtype: list[sqlite3.Row]
+        :param tuple before: (time, id) of an article; only select articles older than it
+        :param tuple after: (time, id) of an article; only select articles newer than it
+        :rtype: list[ArticleSummary]
         """
-        if offset == 0:
-            offset = None
-        result = self.select(self.selection, self.table_name['articles'], conditions,
-                             order_by='time', desc=True, limit=limit, offset=offset)
+        conditions = list(conditions)
+        if before is not None:
+            conditions.append((('time', 'id'), '<', before))
+        if after is not None:
+            conditions.append((('time', 'id'), '>', after))
+        # pages after a cursor are read towards newer articles from the cursor, then reversed
+        desc = after is None
+        result = self.select(self.list_selection, self.table_name['articles'], conditions,
+                             order_by=('time', 'id'), desc=desc, limit=limit, factory=ArticleSummary.from_row)
+        if result is not None and not desc:
+            result.reverse()
         return result
 
-    @lru_cache()
-    def select_articles_by_time(self, begin=None, end=None, limit=20, page_num=0):
+    @cached
+    def select_articles_by_time(self, begin=None, end=None, limit=20, before=None, after=None):
         """
         :param datetime.datetime begin: begin *begin*
         :param datetime.datetime end: to *end*
         :param int limit: limit number
-        :param int page_num: page number
-        :rtype: list[sqlite3.Row]
+        :param tuple before: (time, id) cursor; see self.select_articles
+        :param tuple after: (time, id) cursor; see self.select_articles
+        :rtype: list[ArticleSummary]
         """
         conditions = []
         if begin is not None:
             conditions.append(('time', '>', begin))
         if end is not None:
             conditions.append(('time', '<', end))
-        result = self.select_articles(conditions, limit, limit * page_num)
+        result = self.select_articles(conditions, limit, before, after)
         return result
 
-    @lru_cache()
-    def select_articles_by_cat(self, cat_slug, limit=20, page_num=0):
+    @cached
+    def select_articles_by_cat(self, cat_slug, limit=20, before=None, after=None):
         """
         :param str cat_slug: category name
         :param int limit: limit number
-        :param int page_num: page number
-        :return: list[sqlite3.Row]
+        :param tuple before: (time, id) cursor; see self.select_articles
+        :param tuple after: (time, id) cursor; see self.select_articles
+        :return: list[ArticleSummary]
         """
         cat_id = self.get_id_by_slug(cat_slug)
         result = None
         if cat_id:
-            result = self.select_articles([('cat_id', '=', cat_id)], limit, limit * page_num)
+            result = self.select_articles([('cat_id', '=', cat_id)], limit, before, after)
         return result
+
+    def select_archives(self):
+        """
+        months that have articles, from the archives table kept by triggers, so no GROUP BY over articles
+        :return: (month, number of articles) of every such month, oldest first; ex: (('2016-10', 3),)
+            None if the query fails
+        :rtype: tuple[tuple[str, int]]|None
+        """
+        rows = self.select(['month', 'count'], self.table_name['archives'], [], order_by='month')
+        if rows is None:
+            return None
+        return tuple((row['month'], row['count']) for row in rows)
+
+    def _fts_query(self, conn, words):
+        """
+        the fts5 query of search words. the trigram tokenizer never matches a word shorter than 3 characters,
+        so such a word is any of the trigrams that start with it, from the {articles}_fts_vocab table; titles and
+        markdown end with two spaces in the index, so even a word at the end of one starts a trigram
+        :param sqlite3.Connection conn: connection
+        :param list[str] words: search words
+        :return: (fts5 query, words that start too many trigrams to look up, see SHORT_WORD_TRIGRAMS);
+            None if no article has every word
+        :rtype: tuple[str, list[str]]|None
+        """
+        vocab = self.table_name['articles'] + '_fts_vocab'
+        parts = []
+        common = []
+        for word in words:
+            if len(word) >= 3:
+                parts.append(fts_phrase(word))
+                continue
+            # the index keeps trigrams case folded
+            prefix = word.lower()
+            terms = [row[0] for row in conn.execute(
+                'SELECT term FROM {} WHERE term >= ? AND term < ? LIMIT ?'.format(vocab),
+                (prefix, prefix + '\U0010ffff', SHORT_WORD_TRIGRAMS + 1))]
+            if not terms:
+                return None
+            if len(terms) > SHORT_WORD_TRIGRAMS:
+                common.append(word)
+            else:
+                parts.append('({})'.format(' OR '.join(fts_phrase(term) for term in terms)))
+        return ' AND '.join(parts), common
+
+    @staticmethod
+    def _like(column, words):
+        """
+        :param str column: table of the title and md_content columns
+        :param list[str] words: words every article needs, see like_pattern
+        :return: sql of the condition and its parameters
+        :rtype: tuple[str, tuple]
+        """
+        sql = ' AND '.join("({0}.title LIKE ? ESCAPE '\\' OR {0}.md_content LIKE ? ESCAPE '\\')".format(column)
+                           for _ in words)
+        return sql, tuple(like_pattern(word) for word in words for _ in range(2))
+
+    def search_articles(self, query, limit=20, offset=0):
+        """
+        full text search in title and markdown, best match first.
+        in 'title' and 'snippet' of the results, matched text is between HIGHLIGHT_START and HIGHLIGHT_END.
+        words too common to look up in the index, see BlogDB._fts_query, are looked for with LIKE in the articles
+        the other words found. if there are no other words, or no index because sqlite had no trigram
+        tokenizer, the newest articles are read until limit of them have every word; that is quick for common words
+        :param str query: words to search; an article needs all of them
+        :param int limit: limit number
+        :param int offset: offset number
+        :return: rows of id, slug, title, time and snippet
+        :rtype: list[sqlite3.Row]
+        """
+        words = query.split()
+        if not words:
+            return []
+        fts = self.table_name['articles'] + '_fts'
+        marks = (HIGHLIGHT_START, HIGHLIGHT_END)
+        result = []
+        sql = None
+        conn = self.connect()
+        try:
+            start = metrics.now()
+            match, common = '', words
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).fetchone():
+                query_parts = self._fts_query(conn, words)
+                if query_parts is None:
+                    common = []
+                else:
+                    match, common = query_parts
+            if match:
+                # columns of the index are read from the {articles}_text view, so markdown is decompressed
+                like, params = self._like(fts, common)
+                sql = 'SELECT a.id, a.slug, a.time, rtrim(highlight({0}, 0, ?, ?)) AS title, ' \
+                      'rtrim(snippet({0}, 1, ?, ?, ?, 32)) AS snippet ' \
+                      'FROM {0} JOIN {1} AS a ON a.id = {0}.rowid WHERE {0} MATCH ? {2}' \
+                      'ORDER BY rank LIMIT ? OFFSET ?'.format(fts, self.table_name['articles'],
+                                                              'AND ' + like + ' ' if common else '')
+                result = conn.execute(sql, marks + marks + ('...', match) + params + (limit, offset)).fetchall()
+            elif common:
+                # the snippet starts a little before the first word in the markdown; highlighting is left out
+                like, params = self._like('t', common)
+                sql = "SELECT a.id, a.slug, a.time, rtrim(t.title) AS title, rtrim(substr(t.md_content, " \
+                      "max(instr(lower(t.md_content), lower(?)) - 40, 1), 200)) AS snippet " \
+                      'FROM {0}_text AS t JOIN {0} AS a ON a.id = t.id WHERE {1} ' \
+                      'ORDER BY a.time DESC, a.id DESC LIMIT ? OFFSET ?'.format(self.table_name['articles'], like)
+                result = conn.execute(sql, (common[0],) + params + (limit, offset)).fetchall()
+            self._observe('search', fts, sql, start, len(result))
+        except Exception as e:
+            self._failed('search', fts, sql, e)
+        finally:
+            self.release(conn)
+            return result
+
+    def select_rendered(self, key):
+        """
+        :param str key: render.render_key of the markdown
+        :return: row of html and render_ms, or None
+        :rtype: sqlite3.Row|None
+        """
+        result = self.select(['html', 'render_ms'], self.table_name['render_cache'], [('key', '=', key)])
+        return result[0] if result else None
+
+    def save_rendered(self, key, html, render_ms, slug=None):
+        """
+        :param str key: render.render_key of the markdown
+        :param str html: rendered html
+        :param float render_ms: milliseconds the rendering took
+        :param str slug: slug of the article rendered
+        :rtype: bool
+        """
+        return self.insert_many(self.table_name['render_cache'], [{
+            'key': key,
+            'html': html,
+            'render_ms': render_ms,
+            'slug': slug,
+            'time': datetime.datetime.now()
+        }], 'key')
+
+    def select_render_times(self, limit=20):
+        """
+        slowest renders first, to spot pathological articles
+        :param int limit: limit number
+        :return: rows of slug, render_ms and time
+        :rtype: list[sqlite3.Row]
+        """
+        return self.select(['slug', 'render_ms', 'time'], self.table_name['render_cache'], [],
+                           order_by='render_ms', desc=True, limit=limit)
+
+    def select_md_files(self):
+        """
+        :return: rows of slug, mtime and hash of every md file the watcher has seen
+        :rtype: list[sqlite3.Row]
+        """
+        return self.select(['slug', 'mtime', 'hash'], self.table_name['md_files'], [])
+
+    def save_md_file(self, slug, mtime, md_hash):
+        """
+        :param str slug: slug of md/<slug>.md
+        :param float mtime: modification time of the file
+        :param str md_hash: hash of the content of the file
+        :rtype: bool
+        """
+        return self.insert_many(self.table_name['md_files'], [{'slug': slug, 'mtime': mtime, 'hash': md_hash}],
+                                'slug')
+
+    def delete_md_file(self, slug):
+        """
+        :param str slug: slug of md/<slug>.md
+        :rtype: bool
+        """
+        return self.delete(self.table_name['md_files'], [('slug', '=', slug)])
+
+
+class Snapshot:
+    """
+    every article and category at one moment, with the list orders precomputed; never changed once built.
+    times are compared as the strings sqlite keeps, like the queries of BlogDB.select_articles do
+    :param dict articles: slug -> Article
+    :param dict cat_ids: category slug -> id
+    :param dict keys: category id, or None for every article -> sorted list of (time, id)
+    :param dict rows: category id, or None for every article -> rows in the order of keys
+    """
+
+    def __init__(self, articles, cat_ids, keys, rows):
+        self.articles = articles
+        self.cat_ids = cat_ids
+        self.keys = keys
+        self.rows = rows
+
+    @staticmethod
+    def groups(row):
+        """
+        :param Article row: an article
+        :return: the lists the article is in: every article, and its category if it has one
+        :rtype: tuple
+        """
+        if row['cat_id'] is None:
+            return None,
+        return None, row['cat_id']
+
+    @classmethod
+    def build(cls, articles, cat_ids):
+        """
+        :param dict articles: slug -> Article
+        :param dict cat_ids: category slug -> id
+        :rtype: Snapshot
+        """
+        keys = {}
+        rows = {}
+        for row in sorted(articles.values(), key=lambda r: (r['time'], r['id'])):
+            for group in cls.groups(row):
+                keys.setdefault(group, []).append((row['time'], row['id']))
+                rows.setdefault(group, []).append(row)
+        return cls(articles, cat_ids, keys, rows)
+
+    def with_article(self, slug, row):
+        """
+        copy only the lists the article is in
+        :param str slug: slug of a written article
+        :param Article row: the article as it is now; None if it is deleted
+        :return: a new snapshot with the article replaced
+        :rtype: Snapshot
+        """
+        articles = dict(self.articles)
+        keys = dict(self.keys)
+        rows = dict(self.rows)
+        copied = set()
+
+        def lists(group):
+            if group not in copied:
+                copied.add(group)
+                keys[group] = list(keys.get(group, ()))
+                rows[group] = list(rows.get(group, ()))
+            return keys[group], rows[group]
+
+        old = articles.pop(slug, None)
+        if old is not None:
+            for group in self.groups(old):
+                group_keys, group_rows = lists(group)
+                index = bisect.bisect_left(group_keys, (old['time'], old['id']))
+                del group_keys[index]
+                del group_rows[index]
+        if row is not None:
+            articles[slug] = row
+            for group in self.groups(row):
+                group_keys, group_rows = lists(group)
+                index = bisect.bisect_left(group_keys, (row['time'], row['id']))
+                group_keys.insert(index, (row['time'], row['id']))
+                group_rows.insert(index, row)
+        return Snapshot(articles, self.cat_ids, keys, rows)
+
+    def select(self, group, begin=None, end=None, limit=20, before=None, after=None):
+        """
+        the same rows as BlogDB.select_articles, found by bisection
+        :param int group: category id; None means every article
+        :param datetime.datetime begin: only articles after it
+        :param datetime.datetime end: only articles before it
+        :param int limit: limit number
+        :param tuple before: (time, id) cursor; see BlogDB.select_articles
+        :param tuple after: (time, id) cursor; see BlogDB.select_articles
+        :rtype: list[Article]
+        """
+        keys = self.keys.get(group, [])
+        rows = self.rows.get(group, [])
+        low, high = 0, len(keys)
+        if begin is not None:
+            low = bisect.bisect_right(keys, (str(begin), math.inf))
+        if end is not None:
+            high = bisect.bisect_left(keys, (str(end),))
+        if before is not None:
+            high = min(high, bisect.bisect_left(keys, (str(before[0]), before[1])))
+        if limit is None:
+            limit = len(keys)
+        if after is not None:
+            low = max(low, bisect.bisect_right(keys, (str(after[0]), after[1])))
+            result = rows[low:max(low, min(high, low + limit))]
+        else:
+            result = rows[max(low, high - limit):high]
+        result.reverse()
+        return result
+
+
+class SnapshotBlogDB(BlogDB):
+    """
+    BlogDB that answers article and list reads from a Snapshot in memory instead of the database.
+    writes go to the database as usual; then every written article is read again into a new snapshot,
+    swapped in before any cache is invalidated, so pages are never rendered again from the old one.
+    full text search, archives and the other tables are still read from the database.
+    :param Snapshot snapshot: the current snapshot; None until self.load
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SnapshotBlogDB, self).__init__(*args, **kwargs)
+        self.snapshot = None
+        self._snapshot_lock = threading.Lock()  # one writer builds the next snapshot at a time
+
+    def load(self):
+        """
+        read every article and category into a new snapshot
+        :rtype: bool
+        """
+        rows = self.select(self.selection, self.table_name['articles'], [], factory=Article.from_row)
+        cats = self.select(['id', 'slug'], self.table_name['category'], [])
+        if rows is None or cats is None:
+            return False
+        self.snapshot = Snapshot.build({row['slug']: row for row in rows}, {row['slug']: row['id'] for row in cats})
+        return True
+
+    def invalidate_article(self, slug, cat_slug, time):
+        with self._snapshot_lock:
+            if self.snapshot is not None:
+                rows = self.select(self.selection, self.table_name['articles'], [('slug', '=', slug)],
+                                   factory=Article.from_row)
+                if rows is not None:
+                    self.snapshot = self.snapshot.with_article(slug, rows[0] if rows else None)
+        super(SnapshotBlogDB, self).invalidate_article(slug, cat_slug, time)
+
+    def invalidate_all(self):
+        with self._snapshot_lock:
+            if self.snapshot is not None:
+                self.load()
+        super(SnapshotBlogDB, self).invalidate_all()
+
+    def get_id_by_slug(self, slug):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return super(SnapshotBlogDB, self).get_id_by_slug(slug)
+        return snapshot.cat_ids.get(slug)
+
+    def select_article(self, slug):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return super(SnapshotBlogDB, self).select_article(slug)
+        return snapshot.articles.get(slug)
+
+    def select_articles_by_time(self, begin=None, end=None, limit=20, before=None, after=None):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return super(SnapshotBlogDB, self).select_articles_by_time(begin, end, limit, before, after)
+        return snapshot.select(None, begin, end, limit, before, after)
+
+    def select_articles_by_cat(self, cat_slug, limit=20, before=None, after=None):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return super(SnapshotBlogDB, self).select_articles_by_cat(cat_slug, limit, before, after)
+        cat_id = snapshot.cat_ids.get(cat_slug)
+        if not cat_id:
+            return None
+        return snapshot.select(cat_id, limit=limit, before=before, after=after)
+
+
+class AsyncBlogDB:
+    """
+    awaitable BlogDB: every call runs on a dedicated thread pool, never on the event loop.
+    the thread pool is as big as the connection pool, so a worker never waits for a connection.
+    if the database has a Writer, writes run on a second thread pool: they wait there for their transaction
+    to commit, or for room in the write queue, without holding a thread that reads need.
+    :param dict stats: method name -> [calls, total seconds]
+    """
+
+    def __init__(self, database, max_workers=None, write_workers=None):
+        """
+        :param BlogDB database: database to wrap
+        :param int max_workers: number of worker threads; None means database.pool_size
+        :param int write_workers: number of worker threads for writes, if the database has a Writer;
+            the more writes wait at once, the more are committed together. None means database.pool_size
+        """
+        self.database = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or database.pool_size,
+                                            thread_name_prefix='blogdb')
+        self._write_executor = self._executor
+        if database.writer is not None:
+            self._write_executor = ThreadPoolExecutor(max_workers=write_workers or database.pool_size,
+                                                      thread_name_prefix='blogdb-write')
+        self.stats = {}
+
+    async def _run(self, func, *args, executor=None):
+        """
+        :param function func: a method of self.database
+        :param ThreadPoolExecutor executor: thread pool to run it on; None means the one of reads
+        """
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor or self._executor, func, *args)
+        finally:
+            stat = self.stats.setdefault(func.__name__, [0, 0.0])
+            stat[0] += 1
+            stat[1] += time.perf_counter() - start
+
+    def _write(self, func, *args):
+        """
+        :param function func: a method of self.database that writes
+        """
+        return self._run(func, *args, executor=self._write_executor)
+
+    def add_article(self, slug, title, cat_slug, md_content, html_content, author, time=None):
+        return self._write(self.database.add_article, slug, title, cat_slug, md_content, html_content, author, time)
+
+    def delete_article(self, slug):
+        return self._write(self.database.delete_article, slug)
+
+    def delete_articles(self, conditions):
+        return self._write(self.database.delete_articles, conditions)
+
+    def update_article(self, value_dict, slug):
+        return self._write(self.database.update_article, value_dict, slug)
+
+    def get_id_by_slug(self, slug):
+        return self._run(self.database.get_id_by_slug, slug)
+
+    def select_article(self, slug):
+        return self._run(self.database.select_article, slug)
+
+    def select_markdown(self, slug):
+        return self._run(self.database.select_markdown, slug)
+
+    def select_articles_by_time(self, begin=None, end=None, limit=20, before=None, after=None):
+        return self._run(self.database.select_articles_by_time, begin, end, limit, before, after)
+
+    def select_articles_by_cat(self, cat_slug, limit=20, before=None, after=None):
+        return self._run(self.database.select_articles_by_cat, cat_slug, limit, before, after)
+
+    def search_articles(self, query, limit=20, offset=0):
+        return self._run(self.database.search_articles, query, limit, offset)
+
+    def select_rendered(self, key):
+        return self._run(self.database.select_rendered, key)
+
+    def save_rendered(self, key, html, render_ms, slug=None):
+        return self._write(self.database.save_rendered, key, html, render_ms, slug)
+
+    def select_md_files(self):
+        return self._run(self.database.select_md_files)
+
+    def save_md_file(self, slug, mtime, md_hash):
+        return self._write(self.database.save_md_file, slug, mtime, md_hash)
+
+    def delete_md_file(self, slug):
+        return self._write(self.database.delete_md_file, slug)
+
+    def apply_changes(self):
+        return self._run(self.database.apply_changes)
+
+    def close(self):
+        """
+        wait for running queries, then close the database
+        """
+        self._executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        self.database.close()
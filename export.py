@@ -0,0 +1,250 @@
+# coding: utf-8
+"""
+render the whole blog into html files, to be served without python:
+
+    python export.py out
+
+urls map to files by adding '.html' ('/' is index.html), so nginx only needs
+
+    location / { root out; try_files $uri $uri.html =404; }
+
+only pages whose content changed since the last export are rendered again;
+out/.manifest.json keeps a hash of what every page was rendered from.
+"""
+import os
+import re
+import json
+import time
+import datetime
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import tornado.template
+import tornado.web
+import config
+import db
+import handlers
+import assets
+
+template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template')
+static_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+manifest_name = '.manifest.json'
+
+_loader = None
+_out_dir = None
+
+
+def site_options(database):
+    """
+    the same options as BaseHandler.site_options
+    :type database: db.BlogDB
+    :rtype: dict
+    """
+    return {
+        'faviconLink': 'favicon.ico',
+        'headPicLink': 'head.jpg',
+        'blogName': config.blog_name,
+        'dates': handlers.archive_links(database.select_archives(), config.archive_months),
+        'cats': config.categories,
+    }
+
+
+def site_title(title):
+    return str(title) + ' - ' + config.blog_name if title else config.blog_name
+
+
+def url_to_path(url):
+    """
+    :param str url: ex: '/c/note/0'
+    :return: file path relative to the output directory; ex: 'c/note/0.html'
+    :rtype: str
+    """
+    url = url.strip('/')
+    return url + '.html' if url else 'index.html'
+
+
+def static_url(path):
+    """
+    like RequestHandler.static_url: the url of a static file with the hash of its content
+    :param str path: path in the static directory; ex: 'css/main.css'
+    :rtype: str
+    """
+    return '/static/{}?v={}'.format(path, tornado.web.StaticFileHandler.get_version({'static_path': static_path}, path))
+
+
+def _init_worker(out_dir):
+    global _loader, _out_dir
+    _loader = tornado.template.Loader(template_path)
+    _out_dir = out_dir
+
+
+def _render(job):
+    """
+    render a page in a worker process and write it to every path of the page
+    :param tuple job: (template name, template options, paths)
+    :return: number of files written
+    :rtype: int
+    """
+    template_name, options, paths = job
+    html = _loader.load(template_name).generate(static_url=static_url, **options)
+    for path in paths:
+        path = os.path.join(_out_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(html)
+    return len(paths)
+
+
+def list_jobs(fetch, base_link, page_title, limit, first_urls, site):
+    """
+    jobs for every page of a list, walking from the newest article to the oldest
+    :param function fetch: before -> rows, like BlogDB.select_articles_by_cat with limit + 1
+    :param str base_link: link of the list without cursor; ex: '/c/note/'
+    :param str page_title: page title
+    :param int limit: articles in a page
+    :param list[str] first_urls: urls of the first page
+    :param dict site: site_options()
+    :rtype: list[tuple]
+    """
+    jobs = []
+    before = None
+    urls = list(first_urls)
+    while True:
+        rows = fetch(before)
+        options, _ = handlers.archives_options(rows, before, None, base_link, limit)
+        options['pageTitle'] = site_title(page_title)
+        options.update(site)
+        if options['nextLink'] is None:
+            jobs.append(('articles.html', options, urls))
+            return jobs
+        # the previous page link of the next page is an 'a' cursor to its first row, the extra row here;
+        # it shows this page again
+        jobs.append(('articles.html', options, urls + [base_link + handlers.encode_cursor('a', rows[limit])]))
+        before, _ = handlers.decode_cursor(options['nextLink'][len(base_link):])
+        urls = [options['nextLink']]
+
+
+def all_jobs(database):
+    """
+    :type database: db.BlogDB
+    :rtype: list[tuple]
+    """
+    limit = config.article_num
+    site = site_options(database)
+    jobs = []
+    rows = database.select(['slug'], database.table_name['articles'], [])
+    for row in rows or []:
+        options = handlers.article_options(database.select_article(row['slug']))
+        options['pageTitle'] = site_title(options['mainTitle'])
+        options.update(site)
+        jobs.append(('article.html', options, ['/a/' + row['slug']]))
+    jobs += list_jobs(lambda before: database.select_articles_by_time(None, None, limit + 1, before),
+                      '/t/_to_/', None, limit, ['/', '/t/_to_/0'], site)
+    for cat_slug, name in config.categories.items():
+        jobs += list_jobs(lambda before: database.select_articles_by_cat(cat_slug, limit + 1, before),
+                          '/c/{}/'.format(cat_slug), name, limit, ['/c/{}/0'.format(cat_slug)], site)
+    for link, name in site['dates']:
+        begin, end = re.match(r'/t/(.*)_to_(.*)/', link).groups()
+        begin_time = datetime.datetime.fromtimestamp(float(begin))
+        end_time = datetime.datetime.fromtimestamp(float(end))
+        jobs += list_jobs(lambda before: database.select_articles_by_time(begin_time, end_time, limit + 1, before),
+                          '/t/{}_to_{}/'.format(begin, end), name, limit, [link], site)
+    return [(template_name, options, [url_to_path(url) for url in urls]) for template_name, options, urls in jobs]
+
+
+def templates_hash():
+    """
+    hash of every template and static file, so changing one renders every page again;
+    pages link static files with the hash of their content
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for directory in (template_path, static_path):
+        for root, dirs, names in os.walk(directory):
+            dirs.sort()
+            for name in sorted(names):
+                if name.endswith(tuple(suffix for _, suffix in assets.ENCODINGS)):
+                    continue
+                with open(os.path.join(root, name), 'rb') as f:
+                    h.update(name.encode('utf-8') + f.read())
+    return h.hexdigest()
+
+
+def signature(job, base):
+    """
+    :param tuple job: (template name, template options, paths)
+    :param str base: templates_hash()
+    :rtype: str
+    """
+    data = json.dumps([base, job[0], job[1]], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def export(database, out_dir, workers=None, full=False):
+    """
+    :type database: db.BlogDB
+    :param str out_dir: output directory
+    :param int workers: render processes; None means the number of cpus
+    :param bool full: render every page, ignoring the manifest
+    :return: {'pages':, 'rendered':, 'files':, 'removed':, 'query_seconds':, 'render_seconds':}
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    manifest_path = os.path.join(out_dir, manifest_name)
+    old_manifest = {}
+    if not full and os.path.isfile(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            old_manifest = json.load(f)
+
+    jobs = all_jobs(database)
+    base = templates_hash()
+    manifest = {}
+    changed = []
+    for job in jobs:
+        sig = signature(job, base)
+        if any(old_manifest.get(path) != sig or not os.path.isfile(os.path.join(out_dir, path)) for path in job[2]):
+            changed.append(job)
+        for path in job[2]:
+            manifest[path] = sig
+    query_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    shutil.copytree(static_path, os.path.join(out_dir, 'static'), dirs_exist_ok=True)
+    # for nginx gzip_static / brotli_static
+    assets.build(os.path.join(out_dir, 'static'))
+    files = 0
+    if changed:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(out_dir,)) as executor:
+            files = sum(executor.map(_render, changed, chunksize=max(1, len(changed) // 64)))
+    removed = 0
+    for path in old_manifest.keys() - manifest.keys():
+        if os.path.isfile(os.path.join(out_dir, path)):
+            os.remove(os.path.join(out_dir, path))
+            removed += 1
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    render_seconds = time.perf_counter() - start
+
+    return {
+        'pages': len(jobs),
+        'rendered': len(changed),
+        'files': files,
+        'removed': removed,
+        'query_seconds': query_seconds,
+        'render_seconds': render_seconds,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render the blog into static html files')
+    parser.add_argument('out_dir', nargs='?', default='out')
+    parser.add_argument('--workers', type=int, default=None, help='render processes, default: number of cpus')
+    parser.add_argument('--full', action='store_true', help='render every page, not only changed ones')
+    args = parser.parse_args()
+    if not os.path.isfile('blog.db'):
+        exit('no blog.db')
+    stats = export(db.BlogDB(pool_size=config.db_pool_size), args.out_dir, args.workers, args.full)
+    print('{rendered}/{pages} pages rendered, {files} files written, {removed} removed'.format(**stats))
+    print('query {query_seconds:.3f}s, render {render_seconds:.3f}s'.format(**stats))
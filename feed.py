@@ -0,0 +1,130 @@
+# coding: utf-8
+import datetime
+import threading
+from xml.sax.saxutils import escape, quoteattr
+
+
+def atom_time(time):
+    """
+    :param datetime.datetime|str time: local time, as articles keep it
+    :return: ex: '2016-10-01T08:00:00+08:00'
+    :rtype: str
+    """
+    if isinstance(time, str):
+        time = datetime.datetime.fromisoformat(time)
+    return time.astimezone().isoformat(timespec='seconds')
+
+
+def updated_time(row):
+    """
+    :param db.Article row: an article
+    :return: when the article was last written; its time if that is not known
+    :rtype: datetime.datetime|str
+    """
+    return row['modified'] or row['time']
+
+
+def atom_entry(row, base_url):
+    """
+    :param db.Article row: an article from BlogDB.select_article
+    :param str base_url: ex: 'https://example.com'
+    :rtype: str
+    """
+    link = base_url + '/a/' + row['slug']
+    return ('<entry>\n'
+            '<title>{}</title>\n'
+            '<link rel="alternate" type="text/html" href={}/>\n'
+            '<id>{}</id>\n'
+            '<published>{}</published>\n'
+            '<updated>{}</updated>\n'
+            '<author><name>{}</name></author>\n'
+            '<summary type="html">{}</summary>\n'
+            '<content type="html">{}</content>\n'
+            '</entry>\n').format(escape(row['title']), quoteattr(link), escape(link), atom_time(row['time']),
+                                 atom_time(updated_time(row)), escape(row['author']), escape(row['overview']),
+                                 escape(row['html_content']))
+
+
+class Feed:
+    """
+    atom feed of the newest articles.
+    every entry is serialized once and kept; self.invalidate, a BlogDB listener, only marks the written
+    article, and the next self.build serializes the marked entries again and reuses the others
+    """
+
+    def __init__(self, title, base_url, size=20):
+        """
+        :param str title: title of the feed, the blog name
+        :param str base_url: scheme and host of links; ex: 'https://example.com'
+        :param int size: number of entries
+        """
+        self.title = title
+        self.base_url = base_url
+        self.size = size
+        self._entries = {}  # slug -> (serialized entry, updated_time of the article)
+        self._dirty = set()
+        self._version = 0  # changed by every invalidation, so a feed built meanwhile is not kept
+        self._lock = threading.Lock()
+        self.body = None  # the whole feed as bytes, None if it must be built again
+
+    def invalidate(self, slug, cat_slug, time):
+        """
+        see BlogDB.listeners
+        """
+        with self._lock:
+            if slug is None:
+                self._entries.clear()
+            else:
+                self._dirty.add(slug)
+            self._version += 1
+            self.body = None
+
+    async def build(self, async_database):
+        """
+        :param db.AsyncBlogDB async_database: database
+        :return: the feed
+        :rtype: bytes
+        """
+        base_url = self.base_url
+        with self._lock:
+            if self.body is not None:
+                return self.body
+            version = self._version
+            dirty, self._dirty = self._dirty, set()
+            entries = {slug: entry for slug, entry in self._entries.items() if slug not in dirty}
+
+        rows = await async_database.select_articles_by_time(None, None, self.size) or []
+        parts = []
+        modified = []
+        for row in rows:
+            entry = entries.get(row['slug'])
+            if entry is None:
+                article = await async_database.select_article(row['slug'])
+                if article is None:
+                    continue
+                entry = entries[row['slug']] = atom_entry(article, base_url), updated_time(article)
+            parts.append(entry[0])
+            modified.append(entry[1])
+        # the last time an article in the feed was written
+        updated = atom_time(max(modified) if modified else datetime.datetime.now())
+        body = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+                '<title>{}</title>\n'
+                '<link rel="alternate" type="text/html" href={}/>\n'
+                '<link rel="self" type="application/atom+xml" href={}/>\n'
+                '<id>{}</id>\n'
+                '<updated>{}</updated>\n'
+                '{}</feed>\n').format(escape(self.title), quoteattr(base_url + '/'),
+                                      quoteattr(base_url + '/feed.xml'), escape(base_url + '/'), updated,
+                                      ''.join(parts)).encode('utf-8')
+
+        with self._lock:
+            # entries of articles no longer in the feed are dropped
+            kept = {row['slug'] for row in rows}
+            if version == self._version:
+                self._entries = {slug: entry for slug, entry in entries.items() if slug in kept}
+                self.body = body
+            else:
+                # written meanwhile, entries built here may be stale already
+                self._dirty |= dirty
+        return body
@@ -1,92 +1,395 @@
 # coding: utf-8
+import asyncio
 import datetime
+import email.utils
+import gzip
+import hashlib
+import ipaddress
+import collections
 import tornado.web
+import tornado.escape
+import tornado.template
 import os
-import markdown2
+import mimetypes
+from urllib.parse import urlencode
+from db import HIGHLIGHT_START, HIGHLIGHT_END
+import metrics
+from assets import ENCODINGS
 
+# templates that extend index.html; BaseHandler.render_string renders only their main block
+LAYOUT_PAGES = ('article.html', 'articles.html', 'search.html')
 
-def get_overview(whole_article):
+# where the title and the main block go in the layout
+TITLE_MARK = '\x00title\x00'
+MAIN_MARK = '\x00main\x00'
+
+# a rendered page in the page cache
+Page = collections.namedtuple('Page', ['body', 'gzip_body', 'etag', 'gzip_etag', 'last_modified'])
+
+
+def make_page(html, last_modified=None):
+    """
+    :param str|bytes html: rendered html
+    :param datetime.datetime|str last_modified: time of the newest article in the page, in local time
+    :return: the page; its Last-Modified is when it is built, or the time of its newest article if that is later,
+        so an edit, a deletion or a new sidebar is newer than every copy a client has
+    :rtype: Page
+    """
+    body = html.encode('utf-8') if isinstance(html, str) else html
+    if isinstance(last_modified, str):
+        last_modified = datetime.datetime.fromisoformat(last_modified) if last_modified else None
+    built = datetime.datetime.now(datetime.timezone.utc)
+    if last_modified is not None:
+        built = max(built, last_modified.astimezone(datetime.timezone.utc))
+    digest = hashlib.sha1(body).hexdigest()
+    # the gzipped body is other bytes, so it has its own strong tag
+    return Page(body, gzip.compress(body, 6), '"{}"'.format(digest), '"{}-gzip"'.format(digest),
+                built.replace(microsecond=0))
+
+
+def invalidate_pages(page_cache, slug, cat_slug, time):
+    """
+    drop cached pages an article is in; a BlogDB listener, see BlogDB.invalidate_article
+    :param cache.ResultCache page_cache: page cache of the application
+    :param str slug: slug of the article; if slug is None, drop every page
+    :param str cat_slug: category of the article
+    :param datetime.datetime time: time of the article
+    """
+    if slug is None:
+        page_cache.clear()
+        return
+
+    def affected(key):
+        if key[0] == 'feed':
+            return True
+        if key[0] == 'cat':
+            return key[1] == cat_slug
+        if key[0] == 'time':
+            begin, end = key[1], key[2]
+            return (begin is None or begin < time) and (end is None or time < end)
+        return False
+    page_cache.invalidate(('article', slug))
+    page_cache.invalidate_where(affected)
+
+
+def encode_cursor(direction, row):
     """
-    :param str whole_article: article
+    cursor in page links: 'b' (older than) or 'a' (newer than), then digits of the time, '-' and the id
+    ex: encode_cursor('b', row) == 'b20161001083000123456-42'
+    :param str direction: 'b' or 'a'
+    :param db.ArticleSummary row: first or last article of a page
     :rtype: str
     """
+    return '{}{}-{}'.format(direction, ''.join(c for c in row['time'] if c.isdigit()), row['id'])
+
+
+def decode_cursor(cursor):
+    """
+    :param str cursor: cursor from encode_cursor; '0', '' or anything not a cursor means the first page
+    :return: (before, after); both are (time, id) or None
+    :rtype: tuple
+    """
     try:
-        end_index = whole_article.index('</p>', 200) + 4
-        return whole_article[0:end_index]
-    except ValueError:
-        return whole_article
+        direction = cursor[0]
+        digits, article_id = cursor[1:].split('-')
+        time = datetime.datetime.strptime(digits, '%Y%m%d%H%M%S%f' if len(digits) > 14 else '%Y%m%d%H%M%S')
+        key = (time, int(article_id))
+    except (IndexError, ValueError):
+        return None, None
+    if direction == 'b':
+        return key, None
+    if direction == 'a':
+        return None, key
+    return None, None
+
+
+def archives_options(rows, before, after, base_link, limit):
+    """
+    options of articles.html but pageTitle
+    :param list[db.ArticleSummary] rows: up to limit + 1 rows; the extra one only tells there is one more page
+    :param tuple before: cursor the rows are selected with
+    :param tuple after: cursor the rows are selected with
+    :param str base_link: link of the list without cursor; ex: '/c/note/'
+    :param int limit: articles in a page
+    :return: (options, time of the newest article or None)
+    :rtype: tuple[dict, str]
+    """
+    rows = rows or []
+    if after is not None:
+        has_newer, has_older = len(rows) > limit, True
+        rows = rows[-limit:]
+    else:
+        has_newer, has_older = before is not None, len(rows) > limit
+        rows = rows[:limit]
+    # the records themselves, articles.html reads them by name
+    archives = rows
+    pre_link = base_link + encode_cursor('a', rows[0]) if rows and has_newer else None
+    next_link = base_link + encode_cursor('b', rows[-1]) if rows and has_older else None
+    category_options = {
+        'archives': archives,
+        'preLink': pre_link,
+        'nextLink': next_link,
+    }
+    last_modified = max(row['time'] for row in rows) if rows else None
+    return category_options, last_modified
+
+
+def archive_links(archives, months=3):
+    """
+    links of the archive periods that have articles, oldest first.
+    no numbers of articles: they are in every page, and export.signature would change for all of them
+    with every new article
+    :param tuple archives: BlogDB.archives, (month, number of articles) of every month with articles
+    :param int months: months in a period, a divisor of 12; 3 means quarters
+    :return: list of (link, name)
+    :rtype: list[tuple[str, str]]
+    """
+    periods = collections.OrderedDict()
+    for month, _ in archives or ():
+        periods[(int(month[:4]), (int(month[5:7]) - 1) // months * months + 1)] = None
+    links = []
+    for year, first in periods:
+        last = first + months - 1
+        begin = datetime.datetime(year, first, 1)
+        end = datetime.datetime(year + last // 12, last % 12 + 1, 1)
+        name = '{}年{}月'.format(year, first)
+        if months > 1:
+            name += ' 至 {}年{}月'.format(year, last)
+        links.append(('/t/{}_to_{}/0'.format(begin.timestamp(), end.timestamp()), name))
+    return links
+
+
+def highlight(text):
+    """
+    escape text from BlogDB.search_articles and wrap its matched parts in <mark>
+    :param str text: title or snippet
+    :rtype: str
+    """
+    return tornado.escape.xhtml_escape(text).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+
+def article_options(row):
+    """
+    options of article.html but pageTitle
+    :param db.Article row: the article, or None
+    :rtype: dict
+    """
+    if row is None:
+        row = {'title': '', 'html_content': '', 'author': '', 'time': ''}
+    return {
+        'mainTitle': row['title'],
+        'content': row['html_content'],
+        'articleAuthor': row['author'],
+        'articleDate': row['time']
+    }
+
+
+class BlockLoader(tornado.template.Loader):
+    """
+    template loader whose index.html is only the main block, so a page template renders only what
+    differs between pages
+    """
+
+    def _create_template(self, name):
+        if name == 'index.html':
+            return tornado.template.Template('{% block main %}{% end %}', name=name, loader=self)
+        return super(BlockLoader, self)._create_template(name)
+
+
+def make_layout(loader, namespace):
+    """
+    render index.html around marks and split it where the title and the main block go
+    :param tornado.template.Loader loader: loader of the templates
+    :param dict namespace: template namespace with the site options
+    :return: (before the title, between the title and the main block, after the main block)
+    :rtype: tuple[bytes, bytes, bytes]
+    """
+    template = tornado.template.Template('{% extends index.html %}{% block main %}' + MAIN_MARK + '{% end %}',
+                                         name='layout.html', loader=loader)
+    html = template.generate(**dict(namespace, pageTitle=TITLE_MARK))
+    before, rest = html.split(TITLE_MARK.encode('utf-8'))
+    middle, after = rest.split(MAIN_MARK.encode('utf-8'))
+    return before, middle, after
 
 
 class BaseHandler(tornado.web.RequestHandler):
-    pass
+    def on_finish(self):
+        # the handler class is the route, so the number of label values stays small
+        metrics.REQUEST_SECONDS.observe(self.request.request_time(), (
+            type(self).__name__, self.request.method, self.get_status()))
+
+    def send_page(self, page):
+        """
+        finish with a cached page: 304 if the client has it, gzipped bytes if the client accepts them
+        :param Page page: page to send
+        """
+        gzipped = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        self.set_header('Etag', page.gzip_etag if gzipped else page.etag)
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Vary', 'Accept-Encoding')
+        if page.last_modified is not None:
+            self.set_header('Last-Modified', page.last_modified)
+        if self.is_not_modified(page):
+            self.set_status(304)
+            self.finish()
+            return
+        if gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+            self.finish(page.gzip_body)
+        else:
+            self.finish(page.body)
+
+    def is_not_modified(self, page):
+        """
+        :param Page page: page to send
+        :rtype: bool
+        """
+        if 'If-None-Match' in self.request.headers:
+            # If-Modified-Since is ignored when If-None-Match is sent
+            return self.check_etag_header()
+        since = self.request.headers.get('If-Modified-Since')
+        if since is None or page.last_modified is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, ValueError):
+            return False
+        return since.tzinfo is not None and since >= page.last_modified
+
+    def site_options(self):
+        """
+        options of index.html every page needs
+        :rtype: dict
+        """
+        return dict(self.application.opts, dates=archive_links(self.application.database.archives,
+                                                                self.application.archive_months))
+
+    def render_string(self, template_name, **kwargs):
+        """
+        pages that extend index.html render only their main block, and the rest comes from
+        application.layout, rendered once for every version of the archives
+        """
+        if template_name not in LAYOUT_PAGES:
+            return super(BaseHandler, self).render_string(template_name, **kwargs)
+        namespace = self.get_template_namespace()
+        namespace.update(kwargs)
+        archives = self.application.database.archives
+        layout = self.application.layout
+        if layout is None or layout[0] is not archives:
+            namespace['dates'] = archive_links(archives, self.application.archive_months)
+            layout = self.application.layout = (archives, make_layout(self.application.layout_loader, namespace))
+        before, middle, after = layout[1]
+        main = self.application.block_loader.load(template_name).generate(**namespace)
+        title = tornado.escape.xhtml_escape(kwargs['pageTitle']).encode('utf-8')
+        return b''.join((before, title, middle, main, after))
+
+    async def send_cached_page(self, key, build):
+        """
+        send the cached page of key, or the page build makes, cached.
+        concurrent requests of a page not cached wait for one build; see ResultCache.async_get_or_set
+        :param tuple key: key of the page; ex: ('article', slug)
+        :param function build: coroutine function without arguments that returns the Page
+        """
+        self.send_page(await self.application.page_cache.async_get_or_set(key, build))
+
+    def render_page(self, template_name, last_modified=None, **kwargs):
+        """
+        :param str template_name: template
+        :param datetime.datetime|str last_modified: time of the newest article in the page
+        :rtype: Page
+        """
+        return make_page(self.render_string(template_name, **kwargs), last_modified)
+
+    def render_archives(self, rows, before, after, base_link, page_title):
+        """
+        render a list page
+        :param list[db.ArticleSummary] rows: see archives_options
+        :param tuple before: cursor the rows are selected with
+        :param tuple after: cursor the rows are selected with
+        :param str base_link: link of the list without cursor; ex: '/c/note/'
+        :param str page_title: page title
+        :rtype: Page
+        """
+        category_options, last_modified = archives_options(rows, before, after, base_link,
+                                                           self.application.article_num)
+        category_options['pageTitle'] = self.application.get_site_title(page_title)
+        return self.render_page('articles.html', last_modified, **category_options, **self.site_options())
 
 
 class ArticleHandler(BaseHandler):
-    def get(self, slug):
-        d = self.application.database
-        row = d.select_article(slug)
-        if row is None:
-            row = {'title': '', 'html_content': '', 'author': '', 'time': ''}
-        article_options = {
-            'mainTitle': row['title'],
-            'content': row['html_content'],
-            'pageTitle': self.application.get_site_title(row['title']),
-            'articleAuthor': row['author'],
-            'articleDate': row['time']
-        }
-        self.render('article.html', **article_options, **self.application.opts)
+    async def get(self, slug):
+        async def build():
+            row = await self.application.async_database.select_article(slug)
+            options = article_options(row)
+            options['pageTitle'] = self.application.get_site_title(options['mainTitle'])
+            return self.render_page('article.html', options['articleDate'], **options, **self.site_options())
+        await self.send_cached_page(('article', slug), build)
 
 
 class TimeHandler(BaseHandler):
-    def get(self, begin=None, end=None, page_num=0):
-        page_num = int(page_num)
-        if begin is not None:
-            begin = datetime.datetime.fromtimestamp(float(begin))
-        if end is not None:
-            end = datetime.datetime.fromtimestamp(float(end))
-        d = self.application.database
-        rows = d.select_articles_by_time(begin, end, self.application.article_num, page_num)
-        archives = []
-        next_link = None
-        pre_link = page_num - 1 if page_num > 0 else None
-        if rows:
-            for row in rows:
-                title = row['title']
-                overview = get_overview(row['html_content'])
-                archives.append({'title': title, 'overview': overview, 'slug': row['slug']})
-            next_link = page_num + 1 if len(rows) >= 20 else None
-        page_title = '{0} to {1}'.format(str(begin), str(end)) if begin or end else None
-        category_options = {
-            'archives': archives,
-            'preLink': pre_link,
-            'nextLink': next_link,
-            'pageTitle': self.application.get_site_title(page_title)
-        }
-        self.render('articles.html', **category_options, **self.application.opts)
+    async def get(self, begin=None, end=None, cursor='0'):
+        base_link = '/t/{}_to_{}/'.format(begin or '', end or '')
+        before, after = decode_cursor(cursor)
+        begin = datetime.datetime.fromtimestamp(float(begin)) if begin else None
+        end = datetime.datetime.fromtimestamp(float(end)) if end else None
+
+        async def build():
+            d = self.application.async_database
+            rows = await d.select_articles_by_time(begin, end, self.application.article_num + 1, before, after)
+            page_title = '{0} to {1}'.format(str(begin), str(end)) if begin or end else None
+            for link, name in archive_links(self.application.database.archives, self.application.archive_months):
+                if link.startswith(base_link):
+                    page_title = name
+            return self.render_archives(rows, before, after, base_link, page_title)
+        # the decoded cursor, so a page has one key however its cursor is written
+        await self.send_cached_page(('time', begin, end, before, after), build)
 
 
 class CatHandler(BaseHandler):
-    def get(self, cat_slug, page_num=0):
-        page_num = int(page_num)
-        d = self.application.database
-        rows = d.select_articles_by_cat(cat_slug, self.application.article_num, page_num)
-        archives = []
-        next_link = None
-        pre_link = page_num - 1 if page_num > 0 else None
-        if rows:
-            for row in rows:
-                title = row['title']
-                overview = get_overview(row['html_content'])
-                archives.append({'title': title, 'overview': overview, 'slug': row['slug']})
-            next_link = page_num + 1 if len(rows) >= 20 else None
-        page_title = self.application.opts['cats'][cat_slug]
-        category_options = {
-            'archives': archives,
+    async def get(self, cat_slug, cursor='0'):
+        before, after = decode_cursor(cursor)
+
+        async def build():
+            d = self.application.async_database
+            rows = await d.select_articles_by_cat(cat_slug, self.application.article_num + 1, before, after)
+            page_title = self.application.opts['cats'][cat_slug]
+            return self.render_archives(rows, before, after, '/c/{}/'.format(cat_slug), page_title)
+        await self.send_cached_page(('cat', cat_slug, before, after), build)
+
+
+class FeedHandler(BaseHandler):
+    async def get(self):
+        self.set_header('Content-Type', 'application/atom+xml; charset=utf-8')
+
+        async def build():
+            return make_page(await self.application.feed.build(self.application.async_database))
+        await self.send_cached_page(('feed',), build)
+
+
+class SearchHandler(BaseHandler):
+    async def get(self):
+        query = self.get_argument('q', '').strip()
+        try:
+            page_num = max(int(self.get_argument('p', '0')), 0)
+        except ValueError:
+            page_num = 0
+        limit = self.application.article_num
+        d = self.application.async_database
+        rows = await d.search_articles(query, limit + 1, limit * page_num)
+        results = []
+        for row in rows[:limit]:
+            results.append({'slug': row['slug'], 'title': highlight(row['title']),
+                            'snippet': highlight(row['snippet'])})
+        pre_link = '/s?' + urlencode({'q': query, 'p': page_num - 1}) if page_num > 0 else None
+        next_link = '/s?' + urlencode({'q': query, 'p': page_num + 1}) if len(rows) > limit else None
+        search_options = {
+            'results': results,
+            'query': query,
             'preLink': pre_link,
             'nextLink': next_link,
-            'pageTitle': self.application.get_site_title(page_title)
+            'pageTitle': self.application.get_site_title(query)
         }
-        self.render('articles.html', **category_options, **self.application.opts)
+        self.render('search.html', **search_options, **self.site_options())
 
 
 class AddHandler(BaseHandler):
@@ -101,7 +404,11 @@ class AddHandler(BaseHandler):
             return
         with open(md_file_name, 'r', encoding='utf-8') as f:
             md_content = await self.application.loop.run_in_executor(None, f.read)
-            html_content = markdown2.markdown(md_content, extras=['fenced-code-blocks'])
+        try:
+            html_content, _ = await self.application.renderer.render(md_content, slug)
+        except asyncio.TimeoutError:
+            self.write('render timeout')
+            return
         try:
             title = self.get_body_arguments('title')[0]
             author = self.get_body_arguments('author')[0]
@@ -111,14 +418,79 @@ class AddHandler(BaseHandler):
             self.write('wrong value')
             return
 
-        d = self.application.database
-        result = await self.application.loop.run_in_executor(None, d.add_article, slug, title, cat, md_content, html_content,
-                                                             author, time)
+        d = self.application.async_database
+        result = await d.add_article(slug, title, cat, md_content, html_content, author, time)
         if result:
-            # clear cache
-            d.select_article.cache_clear()
-            d.select_articles_by_cat.cache_clear()
-            d.select_articles_by_time.cache_clear()
             self.write('success')
         else:
             self.write('add fail')
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(metrics.REGISTRY.render())
+
+
+class ProfileHandler(BaseHandler):
+    """
+    /metrics/profile?on=1 starts the sampling profiler for profile_seconds of blog.ini at most, ?on=0 stops it;
+    without arguments it answers the stacks sampled so far, for flamegraph.pl.
+    stacks show the code of the server, so it is off unless profile_seconds is set, and only answers localhost
+    """
+
+    def get(self):
+        if not self.application.profile_seconds or not ipaddress.ip_address(self.request.remote_ip).is_loopback:
+            raise tornado.web.HTTPError(404)
+        on = self.get_query_argument('on', None)
+        if on is not None:
+            if on == '1':
+                metrics.SAMPLER.start(self.application.profile_seconds)
+            else:
+                metrics.SAMPLER.stop()
+            self.finish('profiler {}\n'.format('on' if metrics.SAMPLER.running else 'off'))
+            return
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.finish(metrics.SAMPLER.folded())
+
+
+class StaticHandler(tornado.web.StaticFileHandler):
+    """
+    serves the .br or .gz copy written by assets.build if the client accepts it.
+    static_url adds ?v=<hash of the content> to urls, and a url with a hash never changes,
+    so it may be cached for a year without asking again
+    """
+
+    CACHE_MAX_AGE = 86400 * 365
+    encoding = None
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(StaticHandler, self).validate_absolute_path(root, absolute_path)
+        if absolute_path is None:
+            return None
+        accepted = self.request.headers.get('Accept-Encoding', '')
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(absolute_path + suffix):
+                self.encoding = encoding
+                return absolute_path + suffix
+        return absolute_path
+
+    def get_content_size(self):
+        if self.encoding is None:
+            return super(StaticHandler, self).get_content_size()
+        # the parent class knows the size of the original file only
+        return os.path.getsize(self.absolute_path)
+
+    def get_content_type(self):
+        if self.encoding is None:
+            return super(StaticHandler, self).get_content_type()
+        # the type of the original file, not of the compressed copy
+        mime_type, _ = mimetypes.guess_type(self.absolute_path[:self.absolute_path.rindex('.')])
+        return mime_type or 'application/octet-stream'
+
+    def set_extra_headers(self, path):
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.encoding is not None:
+            self.set_header('Content-Encoding', self.encoding)
+        if self.get_query_argument('v', None):
+            self.set_header('Cache-Control', 'public, max-age={}, immutable'.format(self.CACHE_MAX_AGE))
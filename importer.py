@@ -0,0 +1,137 @@
+# coding: utf-8
+"""
+import every md/<slug>.md file at once:
+
+    python importer.py md --author jeff --cat note
+
+a file may start with a front matter block to set its own title, author, category or time:
+
+    ---
+    title: Hello
+    cat: program
+    time: 2016-10-01 08:00:00
+    ---
+
+without a title, the first '# heading' or the slug is the title.
+files are rendered in a process pool and written with one executemany in one transaction;
+an article already in the database is updated.
+"""
+import os
+import re
+import sys
+import time
+import datetime
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import config
+import db
+from render import render_markdown, get_overview
+
+front_matter_re = re.compile(r'\A---\s*\n(.*?)\n---\s*\n', re.S)
+heading_re = re.compile(r'^#\s+(.+?)\s*#*\s*$', re.M)
+
+
+def parse_front_matter(text):
+    """
+    :param str text: content of a markdown file
+    :return: (metadata, markdown without the front matter)
+    :rtype: tuple[dict, str]
+    """
+    match = front_matter_re.match(text)
+    if match is None:
+        return {}, text
+    meta = {}
+    for line in match.group(1).splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            meta[key.strip().lower()] = value.strip()
+    return meta, text[match.end():]
+
+
+def read_article(path, author, cat_slug):
+    """
+    read and render a markdown file; runs in a worker process
+    :param str path: path of md/<slug>.md
+    :param str author: author if the file does not set one
+    :param str cat_slug: category if the file does not set one
+    :return: arguments of BlogDB.add_articles
+    :rtype: dict
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        meta, md_content = parse_front_matter(f.read())
+    slug = os.path.splitext(os.path.basename(path))[0]
+    heading = heading_re.search(md_content)
+    html_content = render_markdown(md_content)
+    article_time = meta.get('time')
+    return {
+        'slug': slug,
+        'title': meta.get('title') or (heading.group(1) if heading else slug),
+        'cat_slug': meta.get('cat', cat_slug),
+        'md_content': md_content,
+        'html_content': html_content,
+        'overview': get_overview(html_content),
+        'author': meta.get('author', author),
+        'time': datetime.datetime.fromisoformat(article_time) if article_time else None,
+    }
+
+
+def import_directory(database, md_dir='md', author='', cat_slug=None, workers=None, progress=None):
+    """
+    :type database: db.BlogDB
+    :param str md_dir: directory of markdown files
+    :param str author: author of files without one
+    :param str cat_slug: category of files without one
+    :param int workers: render processes; None means the number of cpus
+    :param function progress: called with (done, total) while rendering
+    :return: {'files':, 'render_seconds':, 'write_seconds':, 'files_per_second':, 'ok':}
+    :rtype: dict
+    """
+    paths = sorted(os.path.join(md_dir, name) for name in os.listdir(md_dir) if name.endswith('.md'))
+    start = time.perf_counter()
+    articles = []
+    if paths:
+        chunksize = max(1, len(paths) // (8 * (workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(workers) as executor:
+            for article in executor.map(read_article, paths, [author] * len(paths), [cat_slug] * len(paths),
+                                        chunksize=chunksize):
+                articles.append(article)
+                if progress is not None:
+                    progress(len(articles), len(paths))
+    render_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ok = database.add_articles(articles)
+    write_seconds = time.perf_counter() - start
+    total = render_seconds + write_seconds
+    return {
+        'files': len(articles),
+        'render_seconds': render_seconds,
+        'write_seconds': write_seconds,
+        'files_per_second': len(articles) / total if total else 0.0,
+        'ok': ok,
+    }
+
+
+def print_progress(done, total):
+    if done == total or done % 100 == 0:
+        sys.stdout.write('\rrendered {}/{}'.format(done, total))
+        if done == total:
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import every markdown file of a directory')
+    parser.add_argument('md_dir', nargs='?', default='md')
+    parser.add_argument('--author', default='', help='author of files without one')
+    parser.add_argument('--cat', default=next(iter(config.categories), None), help='category of files without one')
+    parser.add_argument('--workers', type=int, default=None, help='render processes, default: number of cpus')
+    args = parser.parse_args()
+    if not os.path.isfile('blog.db'):
+        exit('no blog.db, run main.py once first')
+    stats = import_directory(db.BlogDB(pool_size=config.db_pool_size, compress_bodies=config.compress_bodies),
+                             args.md_dir, args.author, args.cat, args.workers, print_progress)
+    if not stats['ok']:
+        exit('import failed')
+    print('{files} files, render {render_seconds:.3f}s, write {write_seconds:.3f}s, '
+          '{files_per_second:.1f} files/s'.format(**stats))
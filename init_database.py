@@ -1,3 +1,235 @@
+import sys
+import sqlite3
+from render import get_overview
+
+
+def _backfill_overview(conn, database):
+    """
+    recompute the overview column of every article
+    :type conn: sqlite3.Connection
+    :type database: db.BlogDB
+    """
+    conn.create_function('get_overview', 1, get_overview, deterministic=True)
+    # decompress() is registered on every pooled connection, see db.ConnectionPool
+    conn.execute('UPDATE {} SET overview = get_overview(decompress(html_content))'.format(
+        database.table_name['articles']))
+
+
+# the trigram tokenizer of fts5, for the full text index, is in sqlite 3.34 and later
+TRIGRAM_SQLITE_VERSION = (3, 34, 0)
+
+# full text index over title and markdown, read from the {articles}_text view, and its trigrams, so words
+# shorter than 3 characters are found too, see db.BlogDB._fts_query; see _search_sqls for the view and
+# the triggers that keep the index in sync
+SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE {articles}_fts USING fts5(title, md_content, "
+    "content='{articles}_text', content_rowid='id', tokenize='trigram')",
+    "CREATE VIRTUAL TABLE {articles}_fts_vocab USING fts5vocab({articles}_fts, 'row')",
+]
+
+
+def _search_sqls(compressed, indexed=True):
+    """
+    sql that makes the {articles}_text view again, and the triggers that keep the full text index in sync.
+    markdown is read with decompress() only if bodies may be compressed: it is a python function registered by
+    db.open_connection, and no other sqlite client, ex: the sqlite3 shell, could write articles through it.
+    title and markdown end with two spaces, so every character of them starts a trigram
+    :param bool compressed: if bodies are or may be stored compressed
+    :param bool indexed: if there is a full text index; False makes only the view
+    :rtype: list[str]
+    """
+    md = "decompress({}.md_content) || '  '" if compressed else "{}.md_content || '  '"
+    title = "{}.title || '  '"
+    sqls = ['DROP TRIGGER IF EXISTS {articles}_fts_insert',
+            'DROP TRIGGER IF EXISTS {articles}_fts_delete',
+            'DROP TRIGGER IF EXISTS {articles}_fts_update',
+            'DROP VIEW IF EXISTS {articles}_text',
+            'CREATE VIEW {articles}_text AS SELECT id, ' + title.format('{articles}') + ' AS title, ' +
+            md.format('{articles}') + ' AS md_content FROM {articles}']
+    if indexed:
+        sqls += ['CREATE TRIGGER {articles}_fts_insert AFTER INSERT ON {articles} BEGIN '
+                 'INSERT INTO {articles}_fts (rowid, title, md_content) '
+                 'VALUES (new.id, ' + title.format('new') + ', ' + md.format('new') + '); END',
+                 'CREATE TRIGGER {articles}_fts_delete AFTER DELETE ON {articles} BEGIN '
+                 "INSERT INTO {articles}_fts ({articles}_fts, rowid, title, md_content) "
+                 "VALUES ('delete', old.id, " + title.format('old') + ', ' + md.format('old') + '); END',
+                 'CREATE TRIGGER {articles}_fts_update AFTER UPDATE OF title, md_content ON {articles} BEGIN '
+                 "INSERT INTO {articles}_fts ({articles}_fts, rowid, title, md_content) "
+                 "VALUES ('delete', old.id, " + title.format('old') + ', ' + md.format('old') + '); '
+                 'INSERT INTO {articles}_fts (rowid, title, md_content) '
+                 'VALUES (new.id, ' + title.format('new') + ', ' + md.format('new') + '); END']
+    return sqls
+
+
+def _has_table(conn, name):
+    """
+    :type conn: sqlite3.Connection
+    :param str name: table name
+    :rtype: bool
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def _if_trigram(sqls):
+    """
+    a migration step that runs sqls only if sqlite has the trigram tokenizer. on an older sqlite the server
+    starts without the full text index and BlogDB.search_articles falls back to LIKE;
+    python init_database.py rebuild-search creates the index after sqlite is upgraded
+    :param list[str] sqls: sql that needs the trigram tokenizer
+    :rtype: function
+    """
+    def run(conn, database):
+        if sqlite3.sqlite_version_info < TRIGRAM_SQLITE_VERSION:
+            print('sqlite {} has no trigram tokenizer, full text search uses LIKE'.format(sqlite3.sqlite_version))
+            return
+        for sql in sqls:
+            conn.execute(sql.format(**database.table_name))
+    return run
+
+
+def _bodies_compressed(conn, database):
+    """
+    :type conn: sqlite3.Connection
+    :type database: db.BlogDB
+    :return: if compress_bodies is set, or any body is stored compressed
+    :rtype: bool
+    """
+    return bool(database.compress_bodies) or conn.execute(
+        "SELECT 1 FROM {} WHERE typeof(md_content) = 'blob' OR typeof(html_content) = 'blob' LIMIT 1".format(
+            database.table_name['articles'])).fetchone() is not None
+
+
+def _set_search(conn, database, compressed=None):
+    """
+    make the {articles}_text view and the full text triggers read markdown the way bodies are stored,
+    if they do not already
+    :type conn: sqlite3.Connection
+    :type database: db.BlogDB
+    :param bool compressed: if bodies may be compressed; None means _bodies_compressed
+    """
+    if compressed is None:
+        compressed = _bodies_compressed(conn, database)
+    view = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?",
+                        (database.table_name['articles'] + '_text',)).fetchone()
+    if view is not None and ('decompress(' in view[0]) == compressed:
+        return
+    for sql in _search_sqls(compressed, _has_table(conn, database.table_name['articles'] + '_fts')):
+        conn.execute(sql.format(**database.table_name))
+
+
+def _make_search(conn, database):
+    """
+    make the full text index again, with its view and triggers; only the view if sqlite has no trigram tokenizer
+    :type conn: sqlite3.Connection
+    :type database: db.BlogDB
+    """
+    trigram = sqlite3.sqlite_version_info >= TRIGRAM_SQLITE_VERSION
+    if not trigram:
+        print('sqlite {} has no trigram tokenizer, full text search uses LIKE'.format(sqlite3.sqlite_version))
+    sqls = ['DROP TABLE IF EXISTS {articles}_fts_vocab', 'DROP TABLE IF EXISTS {articles}_fts']
+    if trigram:
+        sqls += SEARCH_INDEX
+    sqls += _search_sqls(_bodies_compressed(conn, database), trigram)
+    if trigram:
+        sqls.append("INSERT INTO {articles}_fts ({articles}_fts) VALUES ('rebuild')")
+    for sql in sqls:
+        conn.execute(sql.format(**database.table_name))
+
+
+# schema changes made after the first release, in order.
+# PRAGMA user_version holds the number of migrations already applied to a database.
+# a migration is a list of sql, with table names formatted in from database.table_name,
+# or of functions called with (conn, database)
+MIGRATIONS = [
+    # 1: indexes for keyset pagination on (time, id), per category and over all articles
+    ['CREATE INDEX IF NOT EXISTS {articles}_time_idx ON {articles} (time, id)',
+     'CREATE INDEX IF NOT EXISTS {articles}_cat_time_idx ON {articles} (cat_id, time, id)'],
+    # 2: overview computed once when an article is written, instead of on every list page
+    ["ALTER TABLE {articles} ADD COLUMN overview TEXT NOT NULL DEFAULT ''",
+     _backfill_overview],
+    # 3: full text search over title and markdown, kept in sync by triggers.
+    # trigram tokens, so words in chinese text without spaces can be found too
+    [_if_trigram(
+        ["CREATE VIRTUAL TABLE {articles}_fts USING fts5(title, md_content, "
+         "content='{articles}', content_rowid='id', tokenize='trigram')",
+         'CREATE TRIGGER {articles}_fts_insert AFTER INSERT ON {articles} BEGIN '
+         'INSERT INTO {articles}_fts (rowid, title, md_content) VALUES (new.id, new.title, new.md_content); END',
+         'CREATE TRIGGER {articles}_fts_delete AFTER DELETE ON {articles} BEGIN '
+         "INSERT INTO {articles}_fts ({articles}_fts, rowid, title, md_content) "
+         "VALUES ('delete', old.id, old.title, old.md_content); END",
+         'CREATE TRIGGER {articles}_fts_update AFTER UPDATE OF title, md_content ON {articles} BEGIN '
+         "INSERT INTO {articles}_fts ({articles}_fts, rowid, title, md_content) "
+         "VALUES ('delete', old.id, old.title, old.md_content); "
+         'INSERT INTO {articles}_fts (rowid, title, md_content) VALUES (new.id, new.title, new.md_content); END',
+         "INSERT INTO {articles}_fts ({articles}_fts) VALUES ('rebuild')"])],
+    # 4: html of rendered markdown by hash of the source, with the time rendering took
+    ['CREATE TABLE {render_cache} (key CHAR(64) PRIMARY KEY, html TEXT NOT NULL, render_ms REAL NOT NULL, '
+     'slug CHAR(100), time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)',
+     'CREATE INDEX {render_cache}_render_ms_idx ON {render_cache} (render_ms)'],
+    # 5: modification time and content hash of md files, for the md directory watcher
+    ['CREATE TABLE {md_files} (slug CHAR(100) PRIMARY KEY, mtime REAL NOT NULL, hash CHAR(64) NOT NULL)'],
+    # 6: log of article writes, so every process can drop what it cached for them; see BlogDB.apply_changes
+    ['CREATE TABLE {changes} (id INTEGER PRIMARY KEY AUTOINCREMENT, slug CHAR(100), cat_slug CHAR(100), '
+     'time TIMESTAMP, created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)',
+     'CREATE TRIGGER {articles}_changes_insert AFTER INSERT ON {articles} BEGIN '
+     'INSERT INTO {changes} (slug, cat_slug, time) '
+     'VALUES (new.slug, (SELECT slug FROM {category} WHERE id = new.cat_id), new.time); END',
+     'CREATE TRIGGER {articles}_changes_delete AFTER DELETE ON {articles} BEGIN '
+     'INSERT INTO {changes} (slug, cat_slug, time) '
+     'VALUES (old.slug, (SELECT slug FROM {category} WHERE id = old.cat_id), old.time); END',
+     'CREATE TRIGGER {articles}_changes_update AFTER UPDATE ON {articles} BEGIN '
+     'INSERT INTO {changes} (slug, cat_slug, time) '
+     'VALUES (old.slug, (SELECT slug FROM {category} WHERE id = old.cat_id), old.time); '
+     'INSERT INTO {changes} (slug, cat_slug, time) '
+     'VALUES (new.slug, (SELECT slug FROM {category} WHERE id = new.cat_id), new.time); END'],
+    # 7: number of articles in every month, kept by triggers, for the archive links; see BlogDB.select_archives
+    ['CREATE TABLE {archives} (month CHAR(7) PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID',
+     "INSERT INTO {archives} (month, count) SELECT strftime('%Y-%m', time), COUNT(*) FROM {articles} GROUP BY 1",
+     'CREATE TRIGGER {articles}_archives_insert AFTER INSERT ON {articles} BEGIN '
+     "INSERT INTO {archives} (month, count) VALUES (strftime('%Y-%m', new.time), 1) "
+     'ON CONFLICT (month) DO UPDATE SET count = count + 1; END',
+     'CREATE TRIGGER {articles}_archives_delete AFTER DELETE ON {articles} BEGIN '
+     "UPDATE {archives} SET count = count - 1 WHERE month = strftime('%Y-%m', old.time); "
+     'DELETE FROM {archives} WHERE count <= 0; END',
+     'CREATE TRIGGER {articles}_archives_update AFTER UPDATE OF time ON {articles} '
+     "WHEN strftime('%Y-%m', old.time) IS NOT strftime('%Y-%m', new.time) BEGIN "
+     "UPDATE {archives} SET count = count - 1 WHERE month = strftime('%Y-%m', old.time); "
+     'DELETE FROM {archives} WHERE count <= 0; '
+     "INSERT INTO {archives} (month, count) VALUES (strftime('%Y-%m', new.time), 1) "
+     'ON CONFLICT (month) DO UPDATE SET count = count + 1; END'],
+    # 8: bodies may be stored zlib compressed (blog.ini compress_bodies); the full text index reads markdown
+    # through a view that decompresses it, so search works with both kinds
+    [_if_trigram(['DROP TRIGGER IF EXISTS {articles}_fts_insert',
+                  'DROP TRIGGER IF EXISTS {articles}_fts_delete',
+                  'DROP TRIGGER IF EXISTS {articles}_fts_update',
+                  'DROP TABLE IF EXISTS {articles}_fts']),
+     'CREATE VIEW {articles}_text AS SELECT id, title, decompress(md_content) AS md_content FROM {articles}',
+     _if_trigram(["CREATE VIRTUAL TABLE {articles}_fts USING fts5(title, md_content, "
+                  "content='{articles}_text', content_rowid='id', tokenize='trigram')",
+                  "INSERT INTO {articles}_fts ({articles}_fts) VALUES ('rebuild')",
+                  'CREATE TRIGGER {articles}_fts_insert AFTER INSERT ON {articles} BEGIN '
+                  'INSERT INTO {articles}_fts (rowid, title, md_content) '
+                  'VALUES (new.id, new.title, decompress(new.md_content)); END',
+                  'CREATE TRIGGER {articles}_fts_delete AFTER DELETE ON {articles} BEGIN '
+                  "INSERT INTO {articles}_fts ({articles}_fts, rowid, title, md_content) "
+                  "VALUES ('delete', old.id, old.title, decompress(old.md_content)); END",
+                  'CREATE TRIGGER {articles}_fts_update AFTER UPDATE OF title, md_content ON {articles} BEGIN '
+                  "INSERT INTO {articles}_fts ({articles}_fts, rowid, title, md_content) "
+                  "VALUES ('delete', old.id, old.title, decompress(old.md_content)); "
+                  'INSERT INTO {articles}_fts (rowid, title, md_content) '
+                  'VALUES (new.id, new.title, decompress(new.md_content)); END'])],
+    # 9: time an article was last written, for <updated> in the feed; BlogDB sets it on every write
+    ['ALTER TABLE {articles} ADD COLUMN modified TIMESTAMP',
+     'UPDATE {articles} SET modified = time'],
+    # 10: the view and the full text triggers call decompress() only if bodies are compressed,
+    # so other sqlite clients can write articles; see sync_search
+    [_set_search],
+    # 11: titles and markdown end with two spaces in the full text index, and its trigrams are in
+    # {articles}_fts_vocab, so words shorter than 3 characters are found through the index
+    [_make_search],
+]
+
+
 def main(database):
     """
     :type database: db.BlogDB
@@ -25,5 +257,155 @@ def main(database):
             print(e)
             conn.rollback()
     conn.commit()
-    conn.close()
-    return result
+    database.release(conn)
+    return result and migrate(database)
+
+
+def migrate(database):
+    """
+    apply the migrations that the database does not have yet, each one in its own transaction
+    :type database: db.BlogDB
+    :rtype: bool
+    """
+    result = True
+    conn = database.connect()
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, sqls in enumerate(MIGRATIONS[version:], version + 1):
+            print('MIGRATE TO', number)
+            conn.execute('BEGIN')
+            for sql in sqls:
+                if callable(sql):
+                    sql(conn, database)
+                else:
+                    conn.execute(sql.format(**database.table_name))
+            conn.execute('PRAGMA user_version = {}'.format(number))
+            conn.commit()
+    except Exception as e:
+        print(e)
+        conn.rollback()
+        result = False
+    finally:
+        database.release(conn)
+        return result
+
+
+def backfill_overview(database):
+    """
+    recompute the overview of existing articles; ex: after get_overview is changed
+    :type database: db.BlogDB
+    :rtype: bool
+    """
+    result = False
+    conn = database.connect()
+    try:
+        _backfill_overview(conn, database)
+        conn.commit()
+        result = True
+    except Exception as e:
+        print(e)
+        conn.rollback()
+    finally:
+        database.release(conn)
+        return result
+
+
+def rebuild_search(database):
+    """
+    rebuild the full text index from the articles table, then merge it into as few b-trees as possible.
+    the index is created if it is not there, ex: the database was migrated before sqlite had trigram
+    :type database: db.BlogDB
+    :rtype: bool
+    """
+    if sqlite3.sqlite_version_info < TRIGRAM_SQLITE_VERSION:
+        print('sqlite {} has no trigram tokenizer'.format(sqlite3.sqlite_version))
+        return False
+    result = False
+    conn = database.connect()
+    try:
+        if not _has_table(conn, database.table_name['articles'] + '_fts_vocab'):
+            _make_search(conn, database)
+        else:
+            conn.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('rebuild')".format(database.table_name['articles']))
+        conn.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('optimize')".format(database.table_name['articles']))
+        conn.commit()
+        result = True
+    except Exception as e:
+        print(e)
+        conn.rollback()
+    finally:
+        database.release(conn)
+        return result
+
+
+def sync_search(database):
+    """
+    make the full text view and triggers fit compress_bodies and the stored bodies; see _search_sqls
+    :type database: db.BlogDB
+    :rtype: bool
+    """
+    result = False
+    conn = database.connect()
+    try:
+        _set_search(conn, database)
+        conn.commit()
+        result = True
+    except Exception as e:
+        print(e)
+        conn.rollback()
+    finally:
+        database.release(conn)
+        return result
+
+
+def convert_bodies(database, compressed=True):
+    """
+    compress or decompress the bodies of existing articles in place, then VACUUM so the file shrinks.
+    set compress_bodies in blog.ini to the same, so new articles are written the same way.
+    the full text triggers decompress markdown while there are compressed bodies, see _search_sqls
+    :type database: db.BlogDB
+    :param bool compressed: compress if True, else decompress
+    :rtype: bool
+    """
+    if compressed:
+        sql = "UPDATE {0} SET md_content = compress(md_content), html_content = compress(html_content) " \
+              "WHERE typeof(md_content) = 'text' OR typeof(html_content) = 'text'"
+    else:
+        sql = "UPDATE {0} SET md_content = decompress(md_content), html_content = decompress(html_content) " \
+              "WHERE typeof(md_content) = 'blob' OR typeof(html_content) = 'blob'"
+    result = False
+    conn = database.connect()
+    try:
+        if compressed:
+            _set_search(conn, database, True)
+        print('{} articles converted'.format(conn.execute(sql.format(database.table_name['articles'])).rowcount))
+        if not compressed:
+            _set_search(conn, database)
+        # the update trigger indexed every article again, merge the index
+        if _has_table(conn, database.table_name['articles'] + '_fts'):
+            conn.execute("INSERT INTO {0}_fts ({0}_fts) VALUES ('optimize')".format(database.table_name['articles']))
+        conn.commit()
+        conn.execute('VACUUM')
+        result = True
+    except Exception as e:
+        print(e)
+        conn.rollback()
+    finally:
+        database.release(conn)
+        return result
+
+
+if __name__ == '__main__':
+    import db
+
+    commands = {
+        'migrate': migrate,
+        'backfill-overview': backfill_overview,
+        'rebuild-search': rebuild_search,
+        'compress-bodies': convert_bodies,
+        'decompress-bodies': lambda database: convert_bodies(database, False),
+    }
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        exit('usage: python init_database.py {}'.format('|'.join(commands)))
+    if not commands[sys.argv[1]](db.BlogDB()):
+        exit(sys.argv[1] + ' failed')
@@ -1,68 +1,274 @@
 # coding: utf-8
 import os
+import sys
+import time
+import signal
+import functools
 import asyncio
 import tornado.platform.asyncio
 import tornado.web
+import tornado.template
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
 from tornado.options import define, options
 import handlers
+from handlers import invalidate_pages, BlockLoader
 import config
 import init_database
 import db
-
-tornado.platform.asyncio.AsyncIOMainLoop().install()
-loop = asyncio.get_event_loop()
-
-database = db.BlogDB()
-if not os.path.isfile('blog.db'):
-    r = init_database.main(database)
-    if not r:
-        exit('init failed')
+import cache
+import render
+import watcher
+import metrics
+import assets
+import feed
 
 setting = {
     'static_path': os.path.join(os.path.dirname(__file__), "static"),
-    'template_path': os.path.join(os.path.dirname(__file__), 'template')
+    'template_path': os.path.join(os.path.dirname(__file__), 'template'),
+    'static_handler_class': handlers.StaticHandler,
 }
 
-define('favicon_link', os.path.join(setting['static_path'], 'favicon.ico'))
-define('head_pic_link', os.path.join(setting['static_path'], 'head.jpg'))
+# paths in the static directory
+define('favicon_link', 'favicon.ico')
+define('head_pic_link', 'head.jpg')
 define('blog_name', config.blog_name)
-define('dates', config.dates)
+define('base_url', config.base_url)
 define('article_num', config.article_num)
 define('cats', config.categories)
 
-for slug, name in options.cats.items():
+
+def init_blog_database(dbpath='blog.db'):
+    """
+    create or migrate the database and insert the categories.
+    run it once before workers are forked; it leaves no connection open.
+    :param str dbpath: database path
+    :rtype: bool
+    """
+    # before the writer of the database opens, and creates, the file
+    new = not os.path.isfile(dbpath)
+    database = db.BlogDB(dbpath, pool_size=1, write_window_ms=config.write_window_ms,
+                         compress_bodies=config.compress_bodies)
     try:
-        database.insert(database.table_name['category'], {
-            'slug': slug,
-            'name': name
-        })
-    except Exception as e:
-        print(e)
+        if new:
+            if not init_database.main(database):
+                return False
+        elif not init_database.migrate(database):
+            return False
+        # compress_bodies may have been changed since the last start
+        if not init_database.sync_search(database):
+            return False
+        # one transaction; a category already there gets the name of blog.ini
+        cats = [{'slug': slug, 'name': name} for slug, name in options.cats.items()]
+        if not database.insert_many(database.table_name['category'], cats, 'slug'):
+            return False
+        database.prune_changes()
+        return True
+    finally:
+        database.close()
 
 
 class BlogApplication(tornado.web.Application):
-    def __init__(self, handlers=None, default_host="", transforms=None, **settings):
+    def __init__(self, handlers=None, default_host="", transforms=None, dbpath='blog.db', **settings):
         super(BlogApplication, self).__init__(handlers, default_host, transforms, **settings)
-        self.loop = loop
+        self.loop = asyncio.get_event_loop()
         self.article_num = options.article_num
-        self.database = database
+        self.archive_months = config.archive_months
+        self.profile_seconds = config.profile_seconds
+        database_class = db.SnapshotBlogDB if config.snapshot else db.BlogDB
+        self.database = database_class(dbpath, pool_size=config.db_pool_size,
+                                       cache=cache.ResultCache(config.cache_max_bytes, config.cache_ttl,
+                                                               stale=config.cache_stale),
+                                       slow_query_ms=config.slow_query_ms, compress_bodies=config.compress_bodies,
+                                       write_window_ms=config.write_window_ms,
+                                       write_queue_size=config.write_queue_size)
+        if config.snapshot:
+            start = time.perf_counter()
+            self.database.load()
+            print('snapshot: {} articles loaded in {:.2f}s'.format(
+                len(self.database.snapshot.articles) if self.database.snapshot else 0, time.perf_counter() - start))
+        self.async_database = db.AsyncBlogDB(self.database)
+        self.page_cache = cache.ResultCache(config.page_cache_max_bytes, config.page_cache_ttl,
+                                            sizeof=lambda page: len(page.body) + len(page.gzip_body),
+                                            stale=config.cache_stale)
+        self.database.listeners.append(functools.partial(invalidate_pages, self.page_cache))
+        # every page shows the archive periods
+        self.periods = None
+        self.database.archive_listeners.append(self.archives_changed)
+        self.feed = feed.Feed(options.blog_name, options.base_url, options.article_num)
+        self.database.listeners.append(self.feed.invalidate)
+        self.database.refresh_archives()
+        self.periods = self.archive_periods()
+        metrics.register_cache('result', self.database.cache)
+        metrics.register_cache('page', self.page_cache)
+        metrics.register_async_database(self.async_database)
+        if self.database.writer is not None:
+            metrics.register_writer(self.database.writer)
+        self.renderer = render.Renderer(self.async_database, config.render_workers, config.render_timeout)
         self.opts = {
             'faviconLink': options.favicon_link,
             'headPicLink': options.head_pic_link,
             'blogName': options.blog_name,
-            'dates': options.dates,
             'cats': options.cats,
         }
+        # index.html around the main block, see BaseHandler.render_string
+        self.layout = None
+        self.layout_loader = tornado.template.Loader(self.settings['template_path'])
+        self.block_loader = BlockLoader(self.settings['template_path'])
         self.get_site_title = lambda title: str(title) + ' - ' + self.opts['blogName'] if title else self.opts[
             'blogName']
 
+    def archive_periods(self):
+        """
+        :return: links of the archive periods in the sidebar
+        :rtype: list[str]
+        """
+        return [link for link, _ in handlers.archive_links(self.database.archives, self.archive_months)]
+
+    def archives_changed(self):
+        """
+        a BlogDB archive listener. most writes only change the number of articles in a period, which no page
+        shows; every cached page is dropped only when a period appears or disappears
+        """
+        periods = self.archive_periods()
+        if periods != self.periods:
+            self.periods = periods
+            self.page_cache.clear()
+
+    async def follow_changes(self, interval=0.5):
+        """
+        drop cached results and pages of articles written by other workers and processes
+        :param float interval: seconds between checks
+        """
+        while True:
+            try:
+                await self.async_database.apply_changes()
+            except Exception as e:
+                print('changes:', e)
+            await asyncio.sleep(interval)
+
+    def close(self):
+        self.renderer.close()
+        self.async_database.close()
 
-app = BlogApplication([
+
+routes = [
     (r'/', handlers.TimeHandler),
     (r'/t/(.*)_to_(.*)/(.*)', handlers.TimeHandler),
     (r'/a/(.*)', handlers.ArticleHandler),
     (r'/c/(.*)/(.*)', handlers.CatHandler),
+    (r'/s', handlers.SearchHandler),
+    (r'/feed.xml', handlers.FeedHandler),
     (r'/add', handlers.AddHandler),
-], **setting)
-app.listen(8765)
-loop.run_forever()
+    (r'/metrics', handlers.MetricsHandler),
+    (r'/metrics/profile', handlers.ProfileHandler),
+]
+
+
+def make_app(dbpath='blog.db'):
+    """
+    :param str dbpath: database path
+    :rtype: BlogApplication
+    """
+    return BlogApplication(routes, dbpath=dbpath, **setting)
+
+
+# pids of the worker processes -> task id, in the parent process; see fork_workers
+workers = {}
+stopping = False
+
+
+def stop_workers(signum, frame):
+    """
+    SIGTERM in the parent process: pass it on to the workers, and only to them, which shut down cleanly;
+    fork_workers exits once they are all gone
+    """
+    global stopping
+    stopping = True
+    for pid in list(workers):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def fork_workers(num, max_restarts=100):
+    """
+    like tornado.process.fork_processes, but the parent keeps the pids of its workers, so stop_workers
+    signals them and not the whole process group, which may hold the shell or supervisor that started it.
+    a worker that crashes is started again; the parent exits when every worker is gone
+    :param int num: number of workers; 0 means one per cpu
+    :param int max_restarts: crashes to restart after, in total
+    :return: task id of the worker, in the worker; from 0 to num - 1
+    :rtype: int
+    """
+    if num <= 0:
+        num = tornado.process.cpu_count()
+
+    def start(task_id):
+        pid = os.fork()
+        if pid == 0:
+            workers.clear()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            return True
+        workers[pid] = task_id
+        return False
+
+    for task_id in range(num):
+        if start(task_id):
+            return task_id
+    restarts = 0
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in workers:
+            continue
+        task_id = workers.pop(pid)
+        if stopping or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError('too many worker restarts')
+        print('worker {} (pid {}) exited with status {}, restarting'.format(task_id, pid, status))
+        if start(task_id):
+            return task_id
+    sys.exit(0)
+
+
+def main():
+    if not init_blog_database():
+        exit('init failed')
+    assets.build(setting['static_path'])
+    sockets = tornado.netutil.bind_sockets(8765)
+    task_id = None
+    if config.workers != 1:
+        # every worker accepts on the same sockets
+        signal.signal(signal.SIGTERM, stop_workers)
+        task_id = fork_workers(config.workers)
+
+    tornado.platform.asyncio.AsyncIOMainLoop().install()
+    loop = asyncio.get_event_loop()
+    app = make_app()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    changes_task = asyncio.ensure_future(app.follow_changes())
+    md_watcher = watcher.Watcher(app.async_database, app.renderer, 'md', config.watch_interval)
+    # one watcher is enough, it writes to the database every worker reads
+    if config.watch_interval > 0 and task_id in (None, 0):
+        md_watcher.start()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        server.stop()
+        changes_task.cancel()
+        md_watcher.stop()
+        app.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# coding: utf-8
+"""
+counters and histograms kept in memory and served at /metrics in the prometheus text format.
+every worker process has its own, so with several workers a scrape sees one of them.
+"""
+import sys
+import time
+import bisect
+import threading
+import collections
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    """
+    ex: _labels(('op', 'table'), ('select', 'articles')) == '{op="select",table="articles"}'
+    :rtype: str
+    """
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        """
+        :param str name: metric name
+        :param str documentation: help text
+        :param tuple label_names: names of the labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """
+        :param tuple labels: values of the labels, in the order of label_names
+        :param float amount: amount to add
+        """
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, _labels(self.label_names, labels), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param str name: metric name
+        :param str documentation: help text
+        :param tuple label_names: names of the labels
+        :param tuple buckets: upper bounds of the buckets, ascending
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count of each bucket and +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """
+        :param float value: value to observe, ex: seconds
+        :param tuple labels: values of the labels, in the order of label_names
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][index] += 1
+            data[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, _labels(self.label_names, labels, 'le="{}"'.format(bound)), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _labels(self.label_names, labels), total))
+                lines.append('{}_count{} {}'.format(self.name, _labels(self.label_names, labels), cumulative))
+        return lines
+
+
+class CallbackGauge:
+    """
+    a gauge whose values are read when rendered, ex: sizes of caches
+    """
+
+    def __init__(self, name, documentation, label_names, func, metric_type='gauge'):
+        """
+        :param str name: metric name
+        :param str documentation: help text
+        :param tuple label_names: names of the labels
+        :param function func: returns a dict of label values tuple -> value
+        :param str metric_type: 'gauge' or 'counter'
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.func = func
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for labels, value in sorted(self.func().items()):
+            lines.append('{}{} {}'.format(self.name, _labels(self.label_names, labels), value))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        """
+        :return: the metric; a metric of the same name is replaced
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """
+        :return: every metric in the prometheus text format
+        :rtype: str
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Sampler:
+    """
+    sampling profiler: a thread that records the stacks of every other thread every interval seconds.
+    it costs nothing while stopped; self.folded() is the input of flamegraph.pl.
+    it stops by itself after max_seconds, and once there are max_stacks different stacks,
+    new ones are counted together as 'other', so a forgotten profiler neither runs nor grows forever
+    """
+
+    def __init__(self, interval=0.005, max_seconds=60, max_stacks=10000):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_stacks = max_stacks
+        self.stacks = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, max_seconds=None):
+        """
+        :param float max_seconds: seconds to run at most; None means self.max_seconds
+        """
+        if self.running:
+            return
+        self.stop()
+        self._stop.clear()
+        self.stacks.clear()
+        self._thread = threading.Thread(target=self._run, args=(max_seconds or self.max_seconds,),
+                                        name='sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, max_seconds):
+        me = threading.get_ident()
+        deadline = time.monotonic() + max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}:{}'.format(code.co_filename, code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = 'other'
+                self.stacks[stack] += 1
+
+    def folded(self):
+        """
+        :return: one 'frame;frame;frame count' line per stack, most sampled first
+        :rtype: str
+        """
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common())
+
+
+REGISTRY = Registry()
+SAMPLER = Sampler()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'blog_request_seconds', 'time to answer a request', ('handler', 'method', 'status')))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram(
+    'blog_db_query_seconds', 'time of sqlite statements', ('op', 'table')))
+DB_ROWS = REGISTRY.register(Counter(
+    'blog_db_rows_total', 'rows read or written by sqlite statements', ('op', 'table')))
+DB_ERRORS = REGISTRY.register(Counter(
+    'blog_db_errors_total', 'failed sqlite statements', ('op', 'table')))
+DB_SLOW_QUERIES = REGISTRY.register(Counter(
+    'blog_db_slow_queries_total', 'sqlite statements slower than slow_query_ms', ('op', 'table')))
+DB_WRITE_BATCH = REGISTRY.register(Histogram(
+    'blog_db_write_batch_size', 'writes committed in one transaction by the writer', (),
+    (1, 2, 5, 10, 20, 50, 100, 200)))
+RENDER_SECONDS = REGISTRY.register(Histogram(
+    'blog_render_seconds', 'time to render the markdown of an article', (),
+    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)))
+
+
+_caches = {}
+
+
+def _cache_stat(stat):
+    return lambda: {(name,): cache.stats()[stat] for name, cache in _caches.items()}
+
+
+for _stat, _type in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                     ('stale_hits', 'counter'), ('coalesced', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')):
+    REGISTRY.register(CallbackGauge('blog_cache_' + _stat + ('_total' if _type == 'counter' else ''),
+                                    'cache ' + _stat, ('cache',), _cache_stat(_stat), _type))
+
+
+def register_cache(name, cache):
+    """
+    export the stats of a cache.ResultCache
+    :param str name: value of the cache label; ex: 'page'
+    :param cache.ResultCache cache: the cache
+    """
+    _caches[name] = cache
+
+
+def register_async_database(async_database):
+    """
+    export db.AsyncBlogDB.stats: calls of every method and seconds they took, including the wait for a thread
+    :param db.AsyncBlogDB async_database: database
+    """
+    stats = async_database.stats
+    REGISTRY.register(CallbackGauge('blog_db_calls_total', 'calls of AsyncBlogDB methods', ('method',),
+                                    lambda: {(name,): stat[0] for name, stat in stats.items()}, 'counter'))
+    REGISTRY.register(CallbackGauge('blog_db_call_seconds_total', 'seconds spent in AsyncBlogDB methods',
+                                    ('method',), lambda: {(name,): stat[1] for name, stat in stats.items()},
+                                    'counter'))
+
+
+def register_writer(writer):
+    """
+    export the number of writes waiting in a db.Writer
+    :param db.Writer writer: writer of the database
+    """
+    REGISTRY.register(CallbackGauge('blog_db_write_queue', 'writes waiting for the writer', (),
+                                    lambda: {(): writer.queued}))
+
+
+def now():
+    return time.perf_counter()
@@ -0,0 +1,131 @@
+# coding: utf-8
+import sys
+import json
+import time
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import markdown2
+import metrics
+
+# markdown2 extras every article is rendered with
+MARKDOWN_EXTRAS = ['fenced-code-blocks']
+
+
+def render_markdown(md_content):
+    """
+    :param str md_content: markdown
+    :return: html
+    :rtype: str
+    """
+    return str(markdown2.markdown(md_content, extras=MARKDOWN_EXTRAS))
+
+
+def render_key(md_content, extras=MARKDOWN_EXTRAS):
+    """
+    key of rendered html in the render cache; changes with the markdown and the extras
+    :param str md_content: markdown
+    :param list[str] extras: markdown2 extras
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps([extras, md_content]).encode('utf-8')).hexdigest()
+
+
+def timed_render(md_content):
+    """
+    render_markdown in a worker process
+    :param str md_content: markdown
+    :return: (html, milliseconds the rendering took)
+    :rtype: tuple[str, float]
+    """
+    start = time.perf_counter()
+    html = render_markdown(md_content)
+    return html, (time.perf_counter() - start) * 1000
+
+
+class Renderer:
+    """
+    renders markdown in a process pool, so a big article never blocks the event loop,
+    and keeps the html in the render cache table, so rendering the same markdown again is free.
+    a render that times out is killed with the other processes of the pool, and the pool is replaced;
+    the renders it was running or queueing are started again in the new pool.
+    """
+
+    def __init__(self, async_database, workers=None, timeout=30):
+        """
+        :param db.AsyncBlogDB async_database: database of the render cache
+        :param int workers: render processes; None means the number of cpus
+        :param float timeout: seconds to wait for a render
+        """
+        self.async_database = async_database
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = ProcessPoolExecutor(workers)
+
+    def _restart(self, executor):
+        """
+        kill the processes of executor and render in a new pool from now on
+        :param ProcessPoolExecutor executor: the pool a render timed out in
+        """
+        if executor is not self._executor:
+            return
+        self._executor = ProcessPoolExecutor(self.workers)
+        # there is no public way to stop a running task; its other futures fail with BrokenProcessPool
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False)
+
+    async def render(self, md_content, slug=None):
+        """
+        :param str md_content: markdown
+        :param str slug: slug of the article, recorded with the render time
+        :return: (html, milliseconds the rendering took; 0 if it is from the render cache)
+        :rtype: tuple[str, float]
+        :raise asyncio.TimeoutError: if rendering takes more than self.timeout
+        """
+        key = render_key(md_content)
+        row = await self.async_database.select_rendered(key)
+        if row is not None:
+            return row['html'], 0.0
+        loop = asyncio.get_event_loop()
+        while True:
+            executor = self._executor
+            try:
+                html, render_ms = await asyncio.wait_for(loop.run_in_executor(executor, timed_render, md_content),
+                                                         self.timeout)
+                break
+            except asyncio.TimeoutError:
+                self._restart(executor)
+                raise
+            except BrokenProcessPool:
+                if executor is self._executor:
+                    # a process died by itself; maybe on this markdown, so it is not rendered again
+                    self._restart(executor)
+                    raise
+                # killed after another render timed out
+        metrics.RENDER_SECONDS.observe(render_ms / 1000)
+        await self.async_database.save_rendered(key, html, render_ms, slug)
+        return html, render_ms
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_overview(whole_article):
+    """
+    :param str whole_article: article
+    :rtype: str
+    """
+    try:
+        end_index = whole_article.index('</p>', 200) + 4
+        return whole_article[0:end_index]
+    except ValueError:
+        return whole_article
+
+
+if __name__ == '__main__':
+    # python render.py [n]: the n slowest renders
+    import db
+    for row in db.BlogDB().select_render_times(int(sys.argv[1]) if len(sys.argv) > 1 else 20) or []:
+        print('{:10.1f} ms  {}  {}'.format(row['render_ms'], row['time'], row['slug']))
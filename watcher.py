@@ -0,0 +1,128 @@
+# coding: utf-8
+import os
+import time
+import asyncio
+import hashlib
+from importer import parse_front_matter
+
+
+def list_md_files(md_dir):
+    """
+    :param str md_dir: directory of markdown files
+    :return: slug -> modification time; None if there is no such directory
+    :rtype: dict|None
+    """
+    if not os.path.isdir(md_dir):
+        return None
+    mtimes = {}
+    with os.scandir(md_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.md') and entry.is_file():
+                mtimes[entry.name[:-3]] = entry.stat().st_mtime
+    return mtimes
+
+
+def read_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class Watcher:
+    """
+    keeps articles in sync with md/<slug>.md while the server runs.
+    every scan only stats the directory; a file is read, hashed and rendered again only if its
+    modification time changed, and the article is updated only if its content changed.
+    a file that was seen before and is gone deletes its article.
+    updates go through BlogDB, so only the cached pages of changed articles are dropped.
+    """
+
+    def __init__(self, async_database, renderer, md_dir='md', interval=2.0, debounce=1.0):
+        """
+        :param db.AsyncBlogDB async_database: database
+        :param render.Renderer renderer: renderer of changed files
+        :param str md_dir: directory of markdown files
+        :param float interval: seconds between scans
+        :param float debounce: a file changed less than debounce seconds ago may still be being written;
+            it is left for the next scan
+        """
+        self.async_database = async_database
+        self.renderer = renderer
+        self.md_dir = md_dir
+        self.interval = interval
+        self.debounce = debounce
+        self._state = None  # slug -> (mtime, hash), as in the md_files table
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.scan()
+            except Exception as e:
+                print('watcher:', e)
+            await asyncio.sleep(self.interval)
+
+    async def scan(self):
+        """
+        :return: (slugs of updated articles, slugs of deleted articles)
+        :rtype: tuple[list, list]
+        """
+        d = self.async_database
+        loop = asyncio.get_event_loop()
+        if self._state is None:
+            rows = await d.select_md_files()
+            self._state = {row['slug']: (row['mtime'], row['hash']) for row in rows or []}
+        mtimes = await loop.run_in_executor(None, list_md_files, self.md_dir)
+        if mtimes is None:
+            # never delete every article because the directory is missing
+            return [], []
+        now = time.time()
+        updated = []
+        for slug, mtime in mtimes.items():
+            known = self._state.get(slug)
+            if known is not None and known[0] == mtime or now - mtime < self.debounce:
+                continue
+            if await self.sync_file(slug, mtime, known):
+                updated.append(slug)
+        deleted = []
+        for slug in self._state.keys() - mtimes.keys():
+            await d.delete_article(slug)
+            await d.delete_md_file(slug)
+            del self._state[slug]
+            deleted.append(slug)
+        return updated, deleted
+
+    async def sync_file(self, slug, mtime, known):
+        """
+        :param str slug: slug of the changed file
+        :param float mtime: modification time of the file
+        :param tuple known: (mtime, hash) of the file last time, or None if it was never seen
+        :return: whether the article is updated
+        :rtype: bool
+        """
+        d = self.async_database
+        loop = asyncio.get_event_loop()
+        content = await loop.run_in_executor(None, read_file, os.path.join(self.md_dir, slug + '.md'))
+        md_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        result = False
+        if known is None or known[1] != md_hash:
+            stored = await d.select_markdown(slug)
+            meta, md_content = parse_front_matter(content)
+            # a file never seen before is only written if it differs from the article, ex: added by AddHandler
+            if stored is not None and (known is not None or stored != md_content):
+                html_content, _ = await self.renderer.render(md_content, slug)
+                value_dict = {'md_content': md_content, 'html_content': html_content}
+                value_dict.update({key: meta[key] for key in ('title', 'author') if key in meta})
+                if 'cat' in meta:
+                    value_dict['cat_id'] = await d.get_id_by_slug(meta['cat'])
+                result = await d.update_article(value_dict, slug)
+        await d.save_md_file(slug, mtime, md_hash)
+        self._state[slug] = (mtime, md_hash)
+        return result